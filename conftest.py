@@ -0,0 +1,2 @@
+# pytest configuration; its location puts the repository root on sys.path,
+# so tests import the modules as `source.<module>` like rieg2023.qmd does
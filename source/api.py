@@ -1,9 +1,15 @@
-import numpy as np
 from base64 import b64encode
 import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from source.cache import CacheMissError
 import logging
-from time import sleep
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import sleep, monotonic, time
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -98,16 +104,16 @@ logger = logging.getLogger(__name__)
 def check_response(response, Sleeper, Access_token) -> bool:
     # check if access token has expired
     if "Access token has expired" in response.text:
-        access_token = Access_token.renew_token()
+        # renew only if no other request has renewed the token in the meantime
+        stale_token = response.request.headers["Authorization"].removeprefix("Bearer ")
+        Access_token.renew_token(stale_token=stale_token)
         logger.debug("Access token expired. New token acquired.")
-        sleep(2)
         return False
     # wait if robot was detected
     if response.status_code == 403:
-        logger.warning(
-            f"CLIENT.RobotDetected: sleep for {Sleeper.get_sleep()} seconds."
-        )
-        sleep(Sleeper.get_sleep())
+        sleep_time = Sleeper.get_sleep()
+        logger.warning(f"CLIENT.RobotDetected: sleep for {sleep_time:.1f} seconds.")
+        sleep(sleep_time)
         Sleeper.increase_sleep()
         return False
     else:
@@ -115,59 +121,418 @@ def check_response(response, Sleeper, Access_token) -> bool:
         return True
 
 
+ENDPOINTS = {
+    "search": "https://ops.epo.org/3.2/rest-services/published-data/search",
+    "biblio-search": "https://ops.epo.org/3.2/rest-services/published-data/search/biblio",
+    "biblio": "https://ops.epo.org/3.2/rest-services/published-data/publication/docdb/biblio",
+}
+
+# OPS returns at most 100 results per request and no results beyond the 2000th
+PAGE_SIZE = 100
+MAX_RESULTS = 2000
+# max. number of documents per published-data request
+BIBLIO_BATCH_SIZE = 100
+PUBLICATION_NUMBER_PATTERN = re.compile(r"^([A-Z]{2})(\d+)([A-Z]\d?)$")
+
+
+# Function to convert a publication number (e.g. EP3000001A1) to docdb format (EP.3000001.A1)
+def docdb_number(publication_number: str) -> str:
+    match = PUBLICATION_NUMBER_PATTERN.match(publication_number)
+    if match is None:
+        raise ValueError(f"Unexpected publication number: {publication_number}")
+    return ".".join(match.groups())
+
+
+# Function to drop publication numbers docdb_number() rejects, so they do not fail a whole batch
+def valid_publication_numbers(publication_numbers: list) -> list:
+    valid = []
+    for publication_number in publication_numbers:
+        if PUBLICATION_NUMBER_PATTERN.match(publication_number) is None:
+            logger.warning(f"Skipping unexpected publication number: {publication_number}")
+        else:
+            valid.append(publication_number)
+    return valid
+
+
+# class holding a pooled HTTP session to OPS
+# connections are kept alive and reused by all requests (and worker threads) of a harvest
+class OPSClient:
+    def __init__(
+        self,
+        AccessToken,
+        Sleeper,
+        RateLimiter=None,
+        pool_maxsize=16,
+        retries=3,
+        backoff_factor=1.0,
+        timeout=20,
+        Cache=None,
+    ):
+        """
+        Client owning a pooled requests.Session to the OPS REST services.
+
+        Parameters
+        ----------
+        AccessToken : AccessToken
+            Access token used for the Authorization header
+        Sleeper : Sleeper
+            Backoff schedule used if OPS answers with 403 (robot detection);
+            Sleeper.steps is the maximum number of attempts per request
+        RateLimiter : RateLimiter
+            Optional token bucket shared by all workers
+        pool_maxsize : int
+            Number of connections kept alive, should be >= the number of worker threads
+        retries : int
+            Number of retries on connection errors and 5xx responses
+        backoff_factor : float
+            Backoff factor between retries on connection errors and 5xx responses
+        timeout : int
+            Timeout in seconds for each request
+        Cache : ResponseCache
+            Optional on-disk cache of responses; in offline mode AccessToken may be None
+        """
+        self.AccessToken = AccessToken
+        self.Cache = Cache
+        self.Sleeper = Sleeper
+        self.RateLimiter = RateLimiter
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=("GET", "POST"),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.headers.update(
+            {"Accept": "application/json", "Content-Type": "text/plain"}
+        )
+
+    def request(self, method, url, params=None, data=None):
+        if self.Cache is not None:
+            key = self.Cache.key(method, url, params=params, data=data)
+            response = self.Cache.get(key)
+            if response is not None:
+                return response
+            if self.Cache.offline:
+                raise CacheMissError(f"{method} {url} {params} is not cached.")
+        response = self._request(method, url, params=params, data=data)
+        # cache valid responses and empty results (SERVER.EntityNotFound)
+        if self.Cache is not None and response.status_code in (200, 404):
+            self.Cache.set(key, response)
+        return response
+
+    def _request(self, method, url, **kwargs):
+        # retry on expired access tokens and robot detection until the Sleeper is exhausted
+        for attempt in range(self.Sleeper.steps):
+            # wait for a free slot if the request is shared between several workers
+            if self.RateLimiter is not None:
+                self.RateLimiter.acquire()
+            headers = {"Authorization": f"Bearer {self.AccessToken.access_token}"}
+            response = self.session.request(
+                method, url, headers=headers, timeout=self.timeout, **kwargs
+            )
+            if self.RateLimiter is not None:
+                self.RateLimiter.update(response.headers)
+            if check_response(
+                response=response, Sleeper=self.Sleeper, Access_token=self.AccessToken
+            ):
+                return response
+        raise requests.exceptions.RetryError(
+            f"No valid response from {url} after {self.Sleeper.steps} attempts."
+        )
+
+    def make_request(self, query, range_begin, range_end, endpoint="biblio-search"):
+        params = {"Range": f"{range_begin}-{range_end}", "q": query}
+        return self.request("GET", ENDPOINTS[endpoint], params=params)
+
+    def fetch_biblio(self, publication_numbers: list):
+        # bibliographic data of up to 100 documents in one POST request, None if none is valid
+        if len(publication_numbers) > BIBLIO_BATCH_SIZE:
+            raise ValueError(f"Max. {BIBLIO_BATCH_SIZE} documents per request.")
+        publication_numbers = valid_publication_numbers(publication_numbers)
+        if len(publication_numbers) == 0:
+            # nothing left to request
+            return None
+        data = "\n".join(docdb_number(p) for p in publication_numbers)
+        return self.request("POST", ENDPOINTS["biblio"], data=data)
+
+    def paginate_request(
+        self,
+        query,
+        endpoint="biblio-search",
+        page_size=PAGE_SIZE,
+        max_results=MAX_RESULTS,
+        max_workers=4,
+    ):
+        """
+        Generator retrieving all pages of a query.
+        The first page is used to read @total-result-count, the remaining Range windows
+        are requested in parallel. Yields (range_begin, range_end, response) tuples as they arrive.
+
+        Parameters
+        ----------
+        query : str
+            OPS search query
+        page_size : int
+            Number of results per request (max. 100)
+        max_results : int
+            Number of results after which the retrieval stops (OPS returns max. 2000)
+        max_workers : int
+            Number of pages requested at the same time
+        """
+        first = self.make_request(
+            query=query, range_begin=1, range_end=page_size, endpoint=endpoint
+        )
+        yield 1, page_size, first
+        ranges = remaining_ranges(
+            get_total_results(first),
+            page_size,
+            page_size=page_size,
+            max_results=max_results,
+        )
+        if len(ranges) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    self.make_request,
+                    query=query,
+                    range_begin=range_begin,
+                    range_end=range_end,
+                    endpoint=endpoint,
+                ): (range_begin, range_end)
+                for range_begin, range_end in ranges
+            }
+            for future in as_completed(futures):
+                range_begin, range_end = futures[future]
+                yield range_begin, range_end, future.result()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def make_request(
-    query, range_begin, range_end, AccessToken, Sleeper, endpoint="biblio-search"
+    query,
+    range_begin,
+    range_end,
+    AccessToken,
+    Sleeper,
+    endpoint="biblio-search",
+    RateLimiter=None,
+    Client=None,
+    Cache=None,
 ):
-    ep = {
-        "search": "https://ops.epo.org/3.2/rest-services/published-data/search",
-        "biblio-search": "https://ops.epo.org/3.2/rest-services/published-data/search/biblio",
-    }
-    url = ep[endpoint]
-    # define header
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "text/plain",
-        "Authorization": f"Bearer {AccessToken.access_token}",
-    }
-    params = {"Range": f"{range_begin}-{range_end}", "q": query}
-    response = requests.get(url, params=params, headers=headers, timeout=20)
+    # pass a Client to reuse its connections across requests
+    if Client is None:
+        with OPSClient(AccessToken, Sleeper, RateLimiter, Cache=Cache) as Client:
+            return Client.make_request(query, range_begin, range_end, endpoint)
+    return Client.make_request(query, range_begin, range_end, endpoint)
 
-    # check if access token has expired
-    if check_response(response=response, Sleeper=Sleeper, Access_token=AccessToken):
-        return response
-    else:
-        return make_request(
-            query=query,
-            range_begin=range_begin,
-            range_end=range_end,
-            AccessToken=AccessToken,
-            Sleeper=Sleeper,
+
+def paginate_request(
+    query,
+    AccessToken,
+    Sleeper,
+    endpoint="biblio-search",
+    RateLimiter=None,
+    page_size=PAGE_SIZE,
+    max_results=MAX_RESULTS,
+    max_workers=4,
+    Cache=None,
+):
+    # all pages of the query share the connections of one client
+    with OPSClient(
+        AccessToken, Sleeper, RateLimiter, pool_maxsize=max_workers, Cache=Cache
+    ) as Client:
+        yield from Client.paginate_request(
+            query,
+            endpoint=endpoint,
+            page_size=page_size,
+            max_results=max_results,
+            max_workers=max_workers,
         )
 
 
+# Function to read the total number of results from the first page of a search
+def get_total_results(response) -> int:
+    if response.status_code != 200:
+        # e.g. SERVER.EntityNotFound if the query has no results
+        return 0
+    return int(
+        response.json()["ops:world-patent-data"]["ops:biblio-search"][
+            "@total-result-count"
+        ]
+    )
+
+
+# Function to create the remaining Range windows after the first page
+def remaining_ranges(
+    total_results, range_end, page_size=PAGE_SIZE, max_results=MAX_RESULTS
+) -> list:
+    last = min(total_results, max_results)
+    return [
+        (begin, min(begin + page_size - 1, last))
+        for begin in range(range_end + 1, last + 1, page_size)
+    ]
+
+
 # class to handle sleep
+# exponential backoff with jitter: the n-th consecutive sleep is drawn from
+# [0.5, 1] * min(end, start * 2**n), steps is the maximum number of attempts
 class Sleeper:
     def __init__(self, start, end, steps):
         self.start = start
         self.end = end
         self.steps = steps
-        self.sleep_array = np.linspace(self.start, self.end, self.steps)
         self.sleep_counter = 0
+        self.lock = threading.Lock()
 
     def increase_sleep(self):
-        self.sleep_counter += 1
+        with self.lock:
+            self.sleep_counter = min(self.sleep_counter + 1, self.steps)
 
     def default_sleep(self):
-        self.sleep_counter = 0
+        with self.lock:
+            self.sleep_counter = 0
 
     def get_sleep(self):
-        return self.sleep_array[self.sleep_counter]
+        with self.lock:
+            sleep_time = min(self.end, self.start * 2**self.sleep_counter)
+        return random.uniform(sleep_time / 2, sleep_time)
+
+
+# class to share the OPS request quota between workers
+# token bucket whose refill rate follows the throttling headers returned by OPS, e.g.
+# X-Throttling-Control: busy (images=green:100, inpadoc=green:45, other=green:1000, retrieval=green:100, search=green:15)
+# the number behind each service is the amount of requests allowed per minute
+class RateLimiter:
+    THROTTLING_PATTERN = re.compile(r"(\w+)=(\w+):(\d+)")
+
+    def __init__(
+        self,
+        service="search",
+        requests_per_minute=30,
+        burst=5,
+        hourly_quota=None,
+        black_sleep=60,
+    ):
+        """
+        Token bucket rate limiter shared by all harvesting workers.
+
+        Parameters
+        ----------
+        service : str
+            OPS service the requests are counted against (e.g. 'search', 'retrieval')
+        requests_per_minute : int
+            Initial refill rate until the first throttling header was received
+        burst : int
+            Maximum number of tokens that can be spent at once
+        hourly_quota : int
+            Individual quota per hour in bytes; requests pause until the next hour once it is used up
+        black_sleep : int
+            Seconds to pause all workers if OPS flags the service as 'black' (over the limit)
+        """
+        self.service = service
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.hourly_quota = hourly_quota
+        self.black_sleep = black_sleep
+        self.quota_used = 0
+        self.status = None
+        self.paused_until = 0.0
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        # block until a token is available and no pause is active
+        while True:
+            with self.lock:
+                self._refill()
+                wait = self.paused_until - monotonic()
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def update(self, headers):
+        # adjust the refill rate to the throttling state reported by OPS
+        throttling = headers.get("X-Throttling-Control")
+        quota_used = headers.get("X-IndividualQuotaPerHour-Used")
+        with self.lock:
+            if throttling is not None:
+                self.status = throttling.split(" ")[0]
+                for service, color, limit in self.THROTTLING_PATTERN.findall(
+                    throttling
+                ):
+                    if service != self.service:
+                        continue
+                    self._refill()
+                    self.rate = max(int(limit), 1) / 60
+                    if color == "black":
+                        logger.warning(
+                            f"OPS service '{service}' is black: pause all requests for {self.black_sleep} seconds."
+                        )
+                        self._pause(self.black_sleep)
+            if quota_used is not None:
+                self.quota_used = int(quota_used)
+                if self.hourly_quota is not None and self.quota_used >= self.hourly_quota:
+                    # wait for the start of the next hour
+                    logger.warning("Hourly OPS quota used up: pause all requests.")
+                    self._pause(3600 - time() % 3600)
+
+    def _pause(self, seconds):
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+        self.tokens = 0.0
 
 
 # class to handle access token
+# the token is renewed in the background shortly before it expires (OPS tokens are valid for 20 minutes)
 class AccessToken:
-    def __init__(self):
-        self.access_token = self.acquire_token()
+    def __init__(self, refresh_margin=60, background=True):
+        """
+        Access token shared by all requests (and worker threads).
+
+        Parameters
+        ----------
+        refresh_margin : int
+            Seconds before expiry at which the token is renewed
+        background : bool
+            Renew the token in a background thread; otherwise it is renewed
+            on the first access after (expires_in - refresh_margin) seconds
+        """
+        self.refresh_margin = refresh_margin
+        self.background = background
+        self.lock = threading.Lock()
+        self.timer = None
+        self.token = None
+        self.expires_at = 0.0
+        self.renew_token()
+
+    @property
+    def access_token(self):
+        # renew synchronously if the background refresh did not happen in time
+        if monotonic() >= self.expires_at:
+            self.renew_token(stale_token=self.token)
+        return self.token
 
     def acquire_token(self):
         headers = {
@@ -188,7 +553,32 @@ class AccessToken:
             timeout=10.0,
         )
         response.raise_for_status()
-        return response.json()["access_token"]
+        return response.json()["access_token"], int(response.json()["expires_in"])
+
+    def renew_token(self, stale_token=None):
+        # only one thread renews the token, the others wait for the lock and reuse the new token
+        with self.lock:
+            if stale_token is not None and stale_token != self.token:
+                return
+            token, expires_in = self.acquire_token()
+            self.token = token
+            refresh_in = max(expires_in - self.refresh_margin, 0)
+            self.expires_at = monotonic() + refresh_in
+            if self.background:
+                if self.timer is not None:
+                    self.timer.cancel()
+                self.timer = threading.Timer(refresh_in, self._refresh, args=(token,))
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _refresh(self, token):
+        try:
+            self.renew_token(stale_token=token)
+            logger.debug("Access token renewed ahead of expiry.")
+        except requests.exceptions.RequestException as e:
+            # the next access will try again synchronously
+            logger.warning(f"Background renewal of access token failed: {e}")
 
-    def renew_token(self):
-        self.access_token = self.acquire_token()
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
@@ -0,0 +1,140 @@
+# module to cache OPS responses on disk
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from time import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class CacheMissError(LookupError):
+    # raised in offline mode if a response is not cached
+    pass
+
+
+class ResponseCache:
+    def __init__(self, directory: str, ttl=None, max_bytes=None, offline=False):
+        """
+        Content-addressed cache of OPS responses.
+        Responses are stored gzip-compressed in directory, one file per request,
+        named by the hash of method, endpoint, query string, Range and body.
+
+        Parameters
+        ----------
+        directory : str
+            Directory holding the cached responses
+        ttl : int
+            Seconds after which a cached response is requested again; None keeps responses forever
+        max_bytes : int
+            Maximum size of the cache on disk; least recently used responses are evicted first
+        offline : bool
+            Serve only from the cache and raise CacheMissError instead of requesting OPS;
+            expired responses are served as well
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # entries in least recently used order: path -> size, the directory is scanned only once
+        self.entries = OrderedDict(
+            (path, os.path.getsize(path))
+            for path in sorted(self._files(), key=os.path.getatime)
+        )
+        self.size = sum(self.entries.values())
+
+    def _files(self) -> list:
+        return [
+            os.path.join(root, name)
+            for root, _, names in os.walk(self.directory)
+            for name in names
+            if name.endswith(".json.gz")
+        ]
+
+    def _path(self, key: str) -> str:
+        # two-level directory layout keeps the number of files per directory small
+        return os.path.join(self.directory, key[:2], key + ".json.gz")
+
+    @staticmethod
+    def key(method, url, params=None, data=None) -> str:
+        content = json.dumps(
+            [method.upper(), url, sorted((params or {}).items()), data],
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        # return the cached response or None if it is missing or expired
+        path = self._path(key)
+        try:
+            modified = os.path.getmtime(path)
+            if self.ttl is not None and time() - modified > self.ttl:
+                if not self.offline:
+                    return None
+                logger.warning(f"Serving expired cache entry {path} in offline mode")
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError):
+            logger.warning(f"Ignoring corrupt cache entry {path}")
+            return None
+        # mark entry as recently used, keep modification time for the ttl
+        os.utime(path, (time(), modified))
+        with self.lock:
+            if path in self.entries:
+                self.entries.move_to_end(path)
+        response = requests.Response()
+        response.status_code = cached["status_code"]
+        response.headers = CaseInsensitiveDict(cached["headers"])
+        response.url = cached["url"]
+        response.encoding = "utf-8"
+        response._content = cached["content"].encode("utf-8")
+        return response
+
+    def set(self, key: str, response) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cached = {
+            "status_code": response.status_code,
+            "headers": dict(response.headers),
+            "url": response.url,
+            "content": response.content.decode("utf-8"),
+        }
+        # write to a temporary file first so readers never see a partial entry
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(cached, f, separators=(",", ":"))
+        with self.lock:
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            self.size += size - self.entries.pop(path, 0)
+            self.entries[path] = size
+            if self.max_bytes is not None and self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # remove least recently used entries until the cache fits into max_bytes
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            path, size = self.entries.popitem(last=False)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def clear(self) -> None:
+        with self.lock:
+            for path in self._files():
+                os.remove(path)
+            self.entries.clear()
+            self.size = 0
@@ -0,0 +1,184 @@
+# module to build a citation graph from the references_cited of extracted documents
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+# ids are stored as fixed width bytes, so the id array can be memory-mapped
+ID_DTYPE = "S32"
+
+
+# Function to create the node id of a document: country + doc-number, as in epodoc citations
+def document_key(country, doc_number):
+    return country + doc_number
+
+
+# Function to collect (citing, cited) pairs from rows returned by extract.extract_biblio
+def edges_from_documents(rows) -> tuple:
+    citing, cited = [], []
+    for row in rows:
+        references = row["references_cited"]
+        if references is None or len(references) == 0:
+            continue
+        key = document_key(row["document_country"], row["document_doc-number"])
+        for reference in references:
+            # tuples from extract_biblio, dicts from the Parquet dataset
+            cited.append(
+                reference["doc_number"]
+                if isinstance(reference, dict)
+                else reference[0]
+            )
+        citing.extend([key] * (len(cited) - len(citing)))
+    return np.array(citing, dtype=ID_DTYPE), np.array(cited, dtype=ID_DTYPE)
+
+
+# Function to collect (citing, cited) pairs from an arrow table (see extract.biblio_schema)
+def edges_from_arrow(table) -> tuple:
+    if pa is None:
+        raise ImportError("Reading arrow tables requires the 'pyarrow' package.")
+    keys = pc.binary_join_element_wise(
+        table["document_country"], table["document_doc-number"], ""
+    )
+    references = table["references_cited"]
+    parents = pc.list_parent_indices(references)
+    cited = pc.struct_field(pc.list_flatten(references), "doc_number")
+    citing = pc.take(keys, parents)
+    return (
+        citing.to_numpy(zero_copy_only=False).astype(ID_DTYPE),
+        cited.to_numpy(zero_copy_only=False).astype(ID_DTYPE),
+    )
+
+
+class CitationGraph:
+    def __init__(self, ids: np.ndarray, indptr: np.ndarray, indices: np.ndarray):
+        """
+        Citation graph in compressed sparse row (CSR) format.
+        Documents are encoded as positions in the sorted array ids; the documents
+        cited by document i are indices[indptr[i]:indptr[i + 1]].
+        Forward citations only count citations by documents in the graph.
+
+        Parameters
+        ----------
+        ids : np.ndarray
+            Sorted document ids (country + doc-number), bytes
+        indptr : np.ndarray
+            Offsets of each document's citations in indices, length len(ids) + 1
+        indices : np.ndarray
+            Positions of the cited documents
+        """
+        self.ids = ids
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.indices)
+
+    @classmethod
+    def from_edges(cls, citing: np.ndarray, cited: np.ndarray):
+        # encode ids and sort the unique edges by citing document
+        ids, codes = np.unique(np.concatenate([citing, cited]), return_inverse=True)
+        codes = codes.astype(np.int64)
+        edges = np.unique(codes[: len(citing)] * len(ids) + codes[len(citing) :])
+        sources, targets = np.divmod(edges, max(len(ids), 1))
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(ids)), out=indptr[1:])
+        return cls(ids.astype(ID_DTYPE), indptr, targets.astype(np.int32))
+
+    @classmethod
+    def from_documents(cls, rows):
+        return cls.from_edges(*edges_from_documents(rows))
+
+    def edges(self) -> tuple:
+        # (citing, cited) ids of all edges
+        sources = np.repeat(np.arange(len(self.ids)), np.diff(self.indptr))
+        return self.ids[sources], self.ids[self.indices]
+
+    def update(self, rows):
+        """
+        Return a new graph with the citations of newly harvested documents added.
+        rows are documents returned by extract.extract_biblio or an arrow table.
+        """
+        if pa is not None and isinstance(rows, pa.Table):
+            citing, cited = edges_from_arrow(rows)
+        else:
+            citing, cited = edges_from_documents(rows)
+        old_citing, old_cited = self.edges()
+        return CitationGraph.from_edges(
+            np.concatenate([old_citing, citing]), np.concatenate([old_cited, cited])
+        )
+
+    def lookup(self, keys) -> np.ndarray:
+        # positions of the documents keys, -1 for documents not in the graph
+        keys = np.asarray(keys, dtype=ID_DTYPE)
+        if len(self.ids) == 0:
+            return np.full(len(keys), -1)
+        positions = np.searchsorted(self.ids, keys)
+        positions = np.minimum(positions, len(self.ids) - 1)
+        found = self.ids[positions] == keys
+        return np.where(found, positions, -1)
+
+    def backward_counts(self) -> np.ndarray:
+        # number of documents cited by each document
+        return np.diff(self.indptr)
+
+    def forward_counts(self) -> np.ndarray:
+        # number of documents citing each document
+        return np.bincount(self.indices, minlength=len(self.ids))
+
+    def cited_by(self, key) -> np.ndarray:
+        # ids of the documents cited by document key
+        position = self.lookup([key])[0]
+        if position < 0:
+            return self.ids[:0]
+        return self.ids[self.indices[self.indptr[position] : self.indptr[position + 1]]]
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        for name in ["ids", "indptr", "indices"]:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(directory, "graph.json"), "w") as f:
+            json.dump({"nodes": len(self.ids), "edges": len(self.indices)}, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True):
+        # arrays are memory-mapped read-only unless mmap is False
+        mmap_mode = "r" if mmap else None
+        return cls(
+            *[
+                np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+                for name in ["ids", "indptr", "indices"]
+            ]
+        )
+
+
+# Function to add forward citation counts and citation weights to the patents DataFrame
+def add_citation_weights(
+    patents_df: pd.DataFrame, graph: CitationGraph
+) -> pd.DataFrame:
+    """
+    Add the columns forward_citations and citation_weight (1 + forward citations)
+    to the DataFrame returned by transform.tf_search_biblio.
+    Pass weight_col="citation_weight" to transform.prep_patents for citation-weighted counts.
+    """
+    keys = (patents_df["document_country"] + patents_df["document_doc-number"]).to_numpy(
+        dtype=ID_DTYPE
+    )
+    positions = graph.lookup(keys)
+    forward = graph.forward_counts()
+    patents_df = patents_df.copy()
+    patents_df["forward_citations"] = np.where(
+        positions >= 0, forward[np.maximum(positions, 0)], 0
+    )
+    patents_df["citation_weight"] = 1 + patents_df["forward_citations"]
+    return patents_df
@@ -1,90 +1,129 @@
+import hashlib
 import itertools
+import os
+import pickle
+import re
 import pandas as pd
 from collections import Counter
 import yaml
 import json
 from datetime import datetime
+from source.utils import count_words_between_quotes
 
 # with open("config.yaml", "r") as stream:
 #         config = yaml.safe_load(stream)
 
 
+# characters and filler words removed from NACE descriptions
+TO_REPLACE = [
+    "(",
+    ")",
+    ", ",
+    ". ",
+    "? ",
+    " of ",
+    " and ",
+    "/",
+    " to ",
+    " in ",
+    " other ",
+    "; ",
+    " for ",
+    " - ",
+    " as ",
+    " own ",
+    " use ",
+    "n.e.c.",
+    "  ",
+]
+
+# keyword index cached in memory, keyed by hash of NACE codes csv and config
+_KEYWORD_CACHE = dict()
+
+
+def clean_text(text: str) -> str:
+    # lower case and replace special characters and filler words by spaces
+    text = text.lower()
+    for char in TO_REPLACE:
+        text = text.replace(char, " ")
+    return text
+
+
+def keyword_cache_key(config: dict) -> str:
+    with open(config["paths"]["nace_codes_csv"], "rb") as f:
+        csv_hash = hashlib.sha256(f.read()).hexdigest()
+    config_hash = hashlib.sha256(
+        json.dumps(config["NACE_INDSUTRIES_LV_1"], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    return f"{csv_hash[:16]}_{config_hash[:16]}"
+
+
 def get_keywords(config: dict) -> dict:
     """
     Get keywords for each NACE code.
     NACE Codes provided by https://github.com/jnsprnw/nace-codes/blob/master/codes.csv
+    The keyword index is built once per NACE codes file and config, and cached in
+    memory and (if config["paths"]["keyword_cache"] is set) on disk.
 
     Parameters
     ----------
-    nace_codes : str
-        NACE codes separated by comma
+    config : dict
+        Configuration dictionary
 
     """
-    to_replace = [
-        "(",
-        ")",
-        ", ",
-        ". ",
-        "? ",
-        " of ",
-        " and ",
-        "/",
-        " to ",
-        " in ",
-        " other ",
-        "; ",
-        " for ",
-        " - ",
-        " as ",
-        " own ",
-        " use ",
-        "n.e.c.",
-        "  ",
-    ]
-    nace_codes = pd.read_csv(config["paths"]["nace_codes_csv"])
-    nace_codes.fillna(method="ffill", inplace=True)
+    key = keyword_cache_key(config)
+    if key in _KEYWORD_CACHE:
+        return _KEYWORD_CACHE[key]
+    cache_dir = config["paths"].get("keyword_cache")
+    cache_path = os.path.join(cache_dir, f"{key}.pkl") if cache_dir else None
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            _KEYWORD_CACHE[key] = pickle.load(f)
+        return _KEYWORD_CACHE[key]
+
+    keyword_index = build_keywords(config)
+    _KEYWORD_CACHE[key] = keyword_index
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, "wb") as f:
+            pickle.dump(keyword_index, f)
+    return keyword_index
+
+
+def build_keywords(config: dict) -> tuple:
+    nace_codes = pd.read_csv(config["paths"]["nace_codes_csv"]).ffill()
 
     # create dictionary of main (mandatory) keywords for each industry
     # keywords are taken from the NACE code descriptions
     # keywords are lower case and special characters are removed
-    industry_keywords = dict()
-    for key in config["NACE_INDSUTRIES_LV_1"].keys():
-        industry_keywords[key] = list()
-        for item in config["NACE_INDSUTRIES_LV_1"][key]:
-            element = item.lower()
-            for char in to_replace:
-                element = element.replace(char, " ")
-            industry_keywords[key].append(element.strip())
-
-    # create dictionary of keywords for each NACE code
+    industry_keywords = {
+        key: [clean_text(item).strip() for item in items]
+        for key, items in config["NACE_INDSUTRIES_LV_1"].items()
+    }
+
+    # create dictionary of keywords for each NACE code in a single pass over the divisions
     # these keywords are part of the search query along with the mandatory keywords for each industry
-    # keywords are lower case and special characters are removed
+    # keywords are lower case, special characters and duplicates are removed (first occurrence is kept)
+    # also map Division to Industry, which is needed to create the keyword strings for each industry
     keywords = dict()
-    for i in nace_codes["Division"].dropna().unique():
-        tmp_df = nace_codes[nace_codes["Division"] == i]
-        activities = " ".join(tmp_df["Activity"].tolist())
-        for char in to_replace:
-            activities = activities.lower().replace(char, " ")
-
-        words = activities.split(" ")
-        for index, word in enumerate(words):
-            words[index] = word.strip()
-        words = list(set(words))
-        # remove empty strings
-        words = list(filter(None, words))
-        keywords[i] = words
-
-    # map Division to Industry
-    # this is needed to create the keyword strings for each industry
     Div_Ind_dict = dict()
-    for i in nace_codes["Division"].dropna().unique():
-        tmp_df = nace_codes[nace_codes["Division"] == i]
-        Div_Ind_dict[i] = tmp_df["Section"].unique().tolist()[0]
+    for division, group in nace_codes.dropna(subset=["Division"]).groupby(
+        "Division", sort=False
+    ):
+        words = clean_text(" ".join(group["Activity"].tolist())).split(" ")
+        words = [word.strip() for word in words]
+        keywords[division] = list(dict.fromkeys(filter(None, words)))
+        Div_Ind_dict[division] = group["Section"].iloc[0]
 
     # return dictionaries mapped by Section and Division
     return keywords, industry_keywords, Div_Ind_dict
 
 
+# Function to get the flat list of CPC symbols used in every query
+def get_cpc_schemes(config: dict) -> list:
+    return list(itertools.chain.from_iterable(config["CPC"].values()))
+
+
 def construct_query(config: dict, save_to_path: str | bool = "data/") -> dict:
     """
     construct query for each country and industry
@@ -109,50 +148,46 @@ def construct_query(config: dict, save_to_path: str | bool = "data/") -> dict:
     keyword_strings = create_keyword_strings(
         config=config, industry_keyword_strings=industry_keyword_strings
     )
-    ls = list(config["CPC_Schemes"].values())  # list of lists
-    ls = list(itertools.chain.from_iterable(ls))  # flatten list
-    cpc_scheme_count = len(ls)  # number of CPC schemes
-    query_terms_count = cpc_scheme_count + 1  # for country
-    q_cpc_schemes = " ".join(ls)
+    q_cpc_schemes = " ".join(get_cpc_schemes(config))
 
     # reverse dictionary
     Ind_Div_dict = reverse_dict(dictionary=Div_Ind_dict)
 
+    # create query templates for each division once
+    # template is a string that contains the main keywords for the industry, the keywords for the division and the CPC schemes
+    # the country is appended for each country below
+    templates = dict()
+    for industry in sorted(set(Div_Ind_dict.values())):
+        templates[industry] = dict()
+        for division in Ind_Div_dict[industry]:
+            # divisions without keywords are skipped
+            if len(keyword_strings[division]) == 0:
+                continue
+            templates[industry][division] = [
+                industry_keyword_strings[industry]
+                + " AND ("
+                + string
+                + " ) "
+                + "AND cpc any "
+                + '"'
+                + q_cpc_schemes
+                + '"'
+                + " AND AP="
+                for string in keyword_strings[division]
+            ]
+
     # create query dictionary
     # iterate over countries, industries, and divisions
-    # create query for each division
-    # query is a string that contains the main keywords for the industry, the keywords for the division, the CPC schemes, and the country
-    query_dict = {}
-    # iterate over countries
-    for country in config["EU_COUNTRY_CODES"].keys():
-        query_dict[country] = dict()
-        # iterate over industries
-        for industry in sorted(set(Div_Ind_dict.values())):
-            query_dict[country][industry] = dict()
-            # iterate over divisions
-            for division in Ind_Div_dict[industry]:
-                query_list = []
-                # iterate over list of keyword strings
-                if len(keyword_strings[division]) == 0:
-                    continue
-                else:
-                    for string in keyword_strings[division]:
-                        tmp_query = (
-                            industry_keyword_strings[Div_Ind_dict[division]]
-                            + " AND ("
-                            + string
-                            + " ) "
-                            + "AND cpc any "
-                            + '"'
-                            + q_cpc_schemes
-                            + '"'
-                            + " AND AP="
-                            + '"'
-                            + country
-                            + '"'
-                        )
-                        query_list.append(tmp_query)
-                query_dict[country][industry][division] = query_list
+    query_dict = {
+        country: {
+            industry: {
+                division: [template + '"' + country + '"' for template in query_list]
+                for division, query_list in divisions.items()
+            }
+            for industry, divisions in templates.items()
+        }
+        for country in config["EU_COUNTRY_CODES"].keys()
+    }
     # save query dictionary to file
     if save_to_path != False:
         filename = datetime.today().strftime("%Y-%m-%d") + "_ops_search_queries.json"
@@ -178,12 +213,11 @@ def create_keyword_strings(config: dict, industry_keyword_strings: dict) -> dict
         Dictionary of keyword strings for each division.
     """
     # max 20 terms in query and max 10 identical identifiers (e.g., "ta =") per query
+    # keyword index is cached, so this does not parse the NACE codes again
     keywords, industry_keywords, Div_Ind_dict = get_keywords(config=config)
 
     # get length of cpc scheme
-    ls = list(config["CPC_Schemes"].values())  # list of lists
-    ls = list(itertools.chain.from_iterable(ls))  # flatten list
-    cpc_scheme_count = len(ls)  # number of CPC schemes
+    cpc_scheme_count = len(get_cpc_schemes(config))  # number of CPC schemes
     query_terms_count = cpc_scheme_count + 1  # for country
 
     keyword_strings = dict()
@@ -208,6 +242,194 @@ def create_keyword_strings(config: dict, industry_keyword_strings: dict) -> dict
     return keyword_strings
 
 
+# OPS limits: max 20 terms per query and max 10 terms per identifier (e.g., "ta")
+MAX_TERMS = 20
+MAX_IDENTIFIER_TERMS = 10
+IDENTIFIER_PATTERN = re.compile(r'\b(ta|cpc|AP)\s*(?:=|ALL|any)\s*"(.*?)"')
+
+
+# Function to count the terms per identifier of a query, e.g. {"ta": 10, "cpc": 7, "AP": 1}
+def count_identifier_terms(query: str) -> Counter:
+    counts = Counter()
+    for identifier, phrase in IDENTIFIER_PATTERN.findall(query):
+        counts[identifier] += 1 if identifier != "cpc" else len(phrase.split())
+    return counts
+
+
+# Function to check a query against the OPS term limits
+def is_valid_query(
+    query: str, max_terms=MAX_TERMS, max_identifier_terms=MAX_IDENTIFIER_TERMS
+) -> bool:
+    if count_words_between_quotes(query) > max_terms:
+        return False
+    counts = count_identifier_terms(query)
+    return all(
+        count <= max_identifier_terms
+        for identifier, count in counts.items()
+        if identifier != "cpc"
+    )
+
+
+def create_country_string(countries: list) -> str:
+    if len(countries) == 1:
+        return 'AP="' + countries[0] + '"'
+    return "(" + " OR ".join(f'AP="{c}"' for c in countries) + ")"
+
+
+# Function to bin-pack keywords into as few keyword strings as possible (first fit decreasing)
+# each string may hold max_words quoted words and max_keywords keywords
+def pack_keywords(keywords: list, max_words: int, max_keywords: int) -> list:
+    bins = []  # [words, keywords]
+    for keyword in sorted(keywords, key=lambda k: len(k.split()), reverse=True):
+        words = len(keyword.split())
+        if words > max_words or max_keywords < 1:
+            raise ValueError(f"Keyword '{keyword}' does not fit into a query.")
+        for b in bins:
+            if b[0] + words <= max_words and len(b[1]) < max_keywords:
+                b[0] += words
+                b[1].append(keyword)
+                break
+        else:
+            bins.append([words, [keyword]])
+    return ["ta = " + " OR ta = ".join(f'"{w}"' for w in b[1]) for b in bins]
+
+
+def plan_queries(
+    config: dict,
+    merge_divisions: bool = False,
+    merge_countries: bool = False,
+    max_terms: int = MAX_TERMS,
+    max_identifier_terms: int = MAX_IDENTIFIER_TERMS,
+) -> dict:
+    """
+    Plan the queries with as few requests as possible.
+    Keywords are bin-packed into the term budget left by the industry keywords,
+    CPC symbols and countries; every query is checked against the OPS term limits.
+    Returns a dictionary with the same structure as construct_query().
+
+    Parameters
+    ----------
+    config : dict
+        Configuration dictionary
+    merge_divisions : bool
+        Pack the (deduplicated) keywords of all divisions of an industry together;
+        the division key is then '*'. prep_patents only uses the industry.
+    merge_countries : bool
+        Combine countries into one 'AP=' disjunction if this reduces the number of queries;
+        the country key is then e.g. 'AT|BE' and results lose their country attribution.
+    max_terms : int
+        Maximum number of terms per query
+    max_identifier_terms : int
+        Maximum number of terms per identifier
+    """
+    keywords, industry_keywords, Div_Ind_dict = get_keywords(config=config)
+    industry_keyword_strings = create_industry_string(
+        industry_keywords=industry_keywords
+    )
+    q_cpc = 'cpc any "' + " ".join(get_cpc_schemes(config)) + '"'
+    countries = list(config["EU_COUNTRY_CODES"].keys())
+    Ind_Div_dict = reverse_dict(dictionary=Div_Ind_dict)
+
+    plan = dict()
+    for industry in sorted(Ind_Div_dict.keys()):
+        # keyword lists to pack, by division or for the whole industry
+        if merge_divisions:
+            groups = {
+                "*": list(
+                    dict.fromkeys(
+                        itertools.chain.from_iterable(
+                            keywords[d] for d in Ind_Div_dict[industry]
+                        )
+                    )
+                )
+            }
+        else:
+            groups = {d: keywords[d] for d in Ind_Div_dict[industry]}
+        fixed = industry_keyword_strings[industry] + " AND " + q_cpc
+        fixed_terms = count_words_between_quotes(fixed)
+        fixed_ta = count_identifier_terms(fixed)["ta"]
+
+        # choose the number of countries per query that minimizes the number of queries
+        best = None
+        sizes = [1]
+        if merge_countries:
+            sizes = range(1, min(len(countries), max_identifier_terms) + 1)
+        for size in sizes:
+            try:
+                strings = {
+                    group: pack_keywords(
+                        words,
+                        max_words=max_terms - fixed_terms - size,
+                        max_keywords=max_identifier_terms - fixed_ta,
+                    )
+                    for group, words in groups.items()
+                    if len(words) > 0
+                }
+            except ValueError:
+                continue
+            n_country_groups = -(-len(countries) // size)  # ceiling division
+            n_queries = n_country_groups * sum(len(v) for v in strings.values())
+            if best is None or n_queries < best[0]:
+                best = (n_queries, size, strings)
+        if best is None:
+            raise ValueError(f"Keywords of industry {industry} do not fit into a query.")
+        _, size, strings = best
+
+        for i in range(0, len(countries), size):
+            country_group = countries[i : i + size]
+            country_key = "|".join(country_group)
+            plan.setdefault(country_key, dict())[industry] = dict()
+            for group, keyword_strings in strings.items():
+                queries = [
+                    industry_keyword_strings[industry]
+                    + " AND ("
+                    + string
+                    + " ) AND "
+                    + q_cpc
+                    + " AND "
+                    + create_country_string(country_group)
+                    for string in keyword_strings
+                ]
+                for query in queries:
+                    if not is_valid_query(query, max_terms, max_identifier_terms):
+                        raise ValueError(f"Planned query exceeds OPS limits: {query}")
+                plan[country_key][industry][group] = queries
+    return plan
+
+
+def plan_report(
+    queries: dict,
+    pages_per_query: float = 1,
+    bytes_per_page: int = 250_000,
+    weekly_quota: int = 4 * 1024**3,
+) -> dict:
+    """
+    Projected request count and quota cost of a query dictionary,
+    returned by plan_queries() or construct_query().
+
+    Parameters
+    ----------
+    queries : dict
+        Dictionary with structure {country:{industry:{division:[queries]}}}
+    pages_per_query : float
+        Expected number of Range pages per query
+    bytes_per_page : int
+        Expected response size per page in bytes
+    weekly_quota : int
+        Weekly OPS quota in bytes (4 GB for non-paying users)
+    """
+    all_queries = return_all_queries(queries)
+    n_requests = len(all_queries) * pages_per_query
+    n_bytes = n_requests * bytes_per_page
+    return {
+        "queries": len(all_queries),
+        "requests": n_requests,
+        "max_terms": max(count_words_between_quotes(q) for q in all_queries),
+        "bytes": n_bytes,
+        "weekly_quota_share": n_bytes / weekly_quota,
+    }
+
+
 # creates keyword string to identify industries (NACE Lv 1)
 # this string is used as a mandatory keyword in the query
 # the string contains all keywords for the industry separated by "OR"
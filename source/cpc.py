@@ -0,0 +1,164 @@
+# module to index the CPC classifications of extracted documents
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# levels of the CPC hierarchy, e.g. G, G06, G06N, G06N3/00, G06N3/08
+LEVELS = ["section", "class", "subclass", "group", "subgroup"]
+# length of the symbol prefix of the levels above the main group
+PREFIX_LENGTHS = {"section": 1, "class": 3, "subclass": 4}
+
+
+# Function to format the parts of a classification (see extract._classifications) as CPC symbol
+def cpc_symbol(parts) -> str:
+    section, cpc_class, subclass, main_group, subgroup = [part.strip() for part in parts[:5]]
+    return f"{section}{cpc_class}{subclass}{main_group}/{subgroup}"
+
+
+class CPCIndex:
+    def __init__(self, symbols: np.ndarray, matrix):
+        """
+        Sparse document x CPC symbol matrix.
+        Symbols are interned: column j of matrix belongs to symbols[j]; row i is the
+        i-th document the index was built from. Entries are 1 if the document is
+        classified with the symbol.
+
+        Parameters
+        ----------
+        symbols : np.ndarray
+            CPC symbols (subgroup level), e.g. 'G06N3/08'
+        matrix : scipy.sparse.csr_matrix
+            Matrix of shape (documents, symbols)
+        """
+        self.symbols = symbols
+        self.matrix = matrix
+
+    @classmethod
+    def from_classifications(cls, classifications, office: str = None):
+        """
+        Build the index from the patent_classifications of extracted documents
+        (see extract.extract_biblio), one row per document.
+
+        Parameters
+        ----------
+        classifications : iterable
+            patent_classifications column of the patents DataFrame
+        office : str
+            Only use classifications of this office, e.g. 'EP'; None uses all
+        """
+        codes = dict()  # symbol -> column
+        rows, cols = [], []
+        n_documents = 0
+        for row, document in enumerate(classifications):
+            n_documents += 1
+            if document is None:
+                continue
+            for classification in document:
+                # classifications are {office: parts} or, from Parquet, flat dicts
+                if "section" in classification:
+                    classification = {
+                        classification["office"]: [
+                            classification["section"],
+                            classification["class"],
+                            classification["subclass"],
+                            classification["main_group"],
+                            classification["subgroup"],
+                        ]
+                    }
+                for classification_office, parts in classification.items():
+                    if office is not None and classification_office != office:
+                        continue
+                    symbol = cpc_symbol(parts)
+                    rows.append(row)
+                    cols.append(codes.setdefault(symbol, len(codes)))
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+            shape=(n_documents, len(codes)),
+        )
+        # documents listed with the same symbol twice (e.g. by two offices) count once
+        matrix.data = np.minimum(matrix.data, 1)
+        return cls(np.array(list(codes), dtype=object), matrix)
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def rollup(self, level: str = "subclass") -> tuple:
+        """
+        Aggregate the symbols to a higher level of the hierarchy.
+        Returns (labels, matrix) with the matrix of shape (documents, labels).
+        """
+        if level == "subgroup":
+            return self.symbols, self.matrix
+        parents = np.array(
+            [_parent(symbol, level) for symbol in self.symbols], dtype=object
+        )
+        labels, columns = np.unique(parents, return_inverse=True)
+        mapping = sparse.csr_matrix(
+            (np.ones(len(parents), dtype=np.int32), (np.arange(len(parents)), columns)),
+            shape=(len(parents), len(labels)),
+        )
+        rolled = (self.matrix @ mapping).tocsr()
+        rolled.data = np.minimum(rolled.data, 1)
+        return labels, rolled
+
+    def counts(
+        self, groups: pd.DataFrame, level: str = "subclass", fields=None
+    ) -> pd.DataFrame:
+        """
+        Number of documents per group and CPC field, as one sparse matrix product.
+
+        Parameters
+        ----------
+        groups : pd.DataFrame
+            Group columns of the documents, one row per row of the index,
+            e.g. patents_df[["query_industry", "document_date_year"]]
+        level : str
+            Level of the fields: section, class, subclass, group or subgroup
+        fields : list
+            Fields to keep, e.g. ['G06N']; None keeps all
+        """
+        labels, matrix = self.rollup(level)
+        if fields is not None:
+            keep = np.isin(labels, fields)
+            labels, matrix = labels[keep], matrix[:, np.flatnonzero(keep)]
+        group_codes, group_index = pd.MultiIndex.from_frame(groups).factorize()
+        group_index = pd.MultiIndex.from_tuples(group_index, names=list(groups.columns))
+        # groups x documents indicator matrix
+        membership = sparse.csr_matrix(
+            (
+                np.ones(len(group_codes), dtype=np.int32),
+                (group_codes, np.arange(len(group_codes))),
+            ),
+            shape=(len(group_index), len(group_codes)),
+        )
+        counts = (membership @ matrix).toarray()
+        return pd.DataFrame(counts, index=group_index, columns=list(labels))
+
+
+def _parent(symbol: str, level: str) -> str:
+    main = symbol.split("/")[0]
+    if level == "group":
+        return main + "/00"
+    return main[: PREFIX_LENGTHS[level]]
+
+
+# Function to count patents by industry, year and CPC field, to be passed to transform.prep_patents
+def field_counts(
+    patents_df: pd.DataFrame,
+    level: str = "subclass",
+    fields=None,
+    office: str = None,
+    prefix: str = "CPC ",
+) -> pd.DataFrame:
+    """
+    Number of patents per industry, year and CPC field of the DataFrame returned by
+    transform.tf_search_biblio. Duplicates are dropped as in transform.prep_patents.
+    Pass the result as extra_regressors to transform.prep_patents.
+    """
+    patents_df = patents_df.drop_duplicates(subset=["query_industry", "document_id"])
+    index = CPCIndex.from_classifications(patents_df["patent_classifications"], office)
+    counts = index.counts(
+        patents_df[["query_industry", "document_date_year"]], level=level, fields=fields
+    )
+    counts.columns = [prefix + column for column in counts.columns]
+    return counts.reset_index()
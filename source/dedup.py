@@ -0,0 +1,217 @@
+# module to deduplicate documents returned by several queries during a harvest
+import hashlib
+import math
+import sqlite3
+import threading
+
+from source.manifest import query_hash
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        """
+        Bloom filter for strings.
+
+        Parameters
+        ----------
+        capacity : int
+            Expected number of items
+        error_rate : float
+            False positive rate at capacity
+        """
+        self.n_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, item: str):
+        # double hashing: positions h1 + i * h2 from one 128 bit digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class DocumentIndex:
+    def __init__(
+        self,
+        path: str,
+        capacity: int = 1_000_000,
+        error_rate: float = 0.001,
+        families: bool = False,
+    ):
+        """
+        Index of documents seen during a harvest.
+        A Bloom filter answers most lookups in memory, the SQLite database holds
+        the exact set of documents and the (query -> document) memberships.
+        Documents are deduplicated by publication number: the analysis counts
+        publications (e.g. the A1 and B1 publication of one application separately),
+        so publications of one patent family are kept unless families is True.
+
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite database, created if it does not exist
+        capacity : int
+            Expected number of unique documents
+        error_rate : float
+            False positive rate of the Bloom filter
+        families : bool
+            Deduplicate by family_id: publications of an already known family are
+            recorded as memberships but not returned as new, so they are not fetched;
+            memberships() then merges the memberships of all publications of a family
+        """
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS documents (
+                    publication_number TEXT PRIMARY KEY,
+                    family_id TEXT,
+                    fetched INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS memberships (
+                    query_hash TEXT NOT NULL,
+                    country TEXT NOT NULL,
+                    industry TEXT NOT NULL,
+                    division TEXT NOT NULL,
+                    publication_number TEXT NOT NULL,
+                    family_id TEXT,
+                    PRIMARY KEY (query_hash, country, industry, division, publication_number)
+                )
+                """
+            )
+            # databases of earlier harvests have no family_id in memberships
+            columns = [
+                row[1] for row in self.connection.execute("PRAGMA table_info(memberships)")
+            ]
+            if "family_id" not in columns:
+                self.connection.execute("ALTER TABLE memberships ADD COLUMN family_id TEXT")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS documents_family_id ON documents (family_id)"
+            )
+        self.bloom = BloomFilter(capacity, error_rate)
+        for (publication_number,) in self.connection.execute(
+            "SELECT publication_number FROM documents"
+        ):
+            self.bloom.add(publication_number)
+        # families are far fewer than documents, so they are held in memory as a set
+        self.families = None
+        if families:
+            self.families = {
+                family_id
+                for (family_id,) in self.connection.execute(
+                    "SELECT DISTINCT family_id FROM documents WHERE family_id IS NOT NULL"
+                )
+            }
+
+    def __contains__(self, publication_number: str) -> bool:
+        if publication_number not in self.bloom:
+            return False
+        # possible false positive, check the exact set
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM documents WHERE publication_number = ?",
+                (publication_number,),
+            ).fetchone()
+        return row is not None
+
+    def add_search_results(self, job, rows: list) -> list:
+        """
+        Record the documents returned by a query (rows of extract.extract_search)
+        and return the publication numbers that have not been seen before
+        (with families, only the first publication of each new family).
+        """
+        if not rows:
+            return []
+        new = []
+        for row in rows:
+            publication_number = row["publication_number"]
+            if publication_number in self or publication_number in new:
+                continue
+            if self.families is not None:
+                if row["family_id"] in self.families:
+                    continue
+                self.families.add(row["family_id"])
+            new.append(publication_number)
+        families = {row["publication_number"]: row["family_id"] for row in rows}
+        key = (query_hash(job.query), job.country, job.industry, job.division)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO documents (publication_number, family_id) VALUES (?, ?)",
+                [(p, families[p]) for p in new],
+            )
+            self.connection.executemany(
+                """
+                INSERT OR IGNORE INTO memberships
+                (query_hash, country, industry, division, publication_number, family_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                [key + (row["publication_number"], row["family_id"]) for row in rows],
+            )
+            for publication_number in new:
+                self.bloom.add(publication_number)
+        return new
+
+    def unfetched(self) -> list:
+        # documents whose bibliographic data has not been retrieved yet
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT publication_number FROM documents WHERE fetched = 0"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def mark_fetched(self, publication_numbers: list) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE documents SET fetched = 1 WHERE publication_number = ?",
+                [(p,) for p in publication_numbers],
+            )
+
+    def memberships(self, publication_numbers: list = None) -> dict:
+        # {publication_number: [(country, industry, division), ...]}
+        # with families, each publication holds the memberships of its whole family,
+        # so the fetched representative carries those of its unfetched siblings
+        with self.lock:
+            rows = self.connection.execute(
+                """
+                SELECT publication_number, family_id, country, industry, division
+                FROM memberships
+                """
+            ).fetchall()
+        if publication_numbers is not None:
+            publication_numbers = set(publication_numbers)
+        memberships = dict()
+        family_memberships = dict()
+        for publication_number, family_id, country, industry, division in rows:
+            edges = memberships.setdefault(publication_number, set())
+            if self.families is not None and family_id is not None:
+                # the publication shares the set of its family
+                family_edges = family_memberships.setdefault(family_id, set())
+                if edges is not family_edges:
+                    family_edges |= edges
+                    memberships[publication_number] = edges = family_edges
+            edges.add((country, industry, division))
+        return {
+            key: sorted(value)
+            for key, value in memberships.items()
+            if publication_numbers is None or key in publication_numbers
+        }
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,251 @@
+# module to resolve applicant and inventor names to stable entity ids
+import re
+import sqlite3
+import threading
+import unicodedata
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# legal forms and filler words dropped from names, e.g. 'Siemens AG' -> 'siemens'
+LEGAL_FORMS = set(
+    """
+    ab ag aktiengesellschaft as asa bv co company corp corporation cv eg ev gbr gmbh
+    inc incorporated kft kg kgaa kk limited llc llp lp ltd mbh nv oy oyj plc sa sarl
+    sas se sl spa spol sro srl the
+    """.split()
+)
+# country suffix of names in epodoc format, e.g. 'SIEMENS AG [DE]'
+COUNTRY_SUFFIX = re.compile(r"\s*\[[A-Z]{2}\]\s*$")
+NON_ALPHANUMERIC = re.compile(r"[^0-9a-z]+")
+# prime of the universal hash functions of the MinHash signatures, a * x fits into 64 bits
+PRIME = (1 << 31) - 1
+
+
+# Function to normalize a name: diacritics, case, punctuation and legal forms
+def normalize_name(name: str) -> str:
+    name = COUNTRY_SUFFIX.sub("", name)
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(c for c in name if not unicodedata.combining(c)).lower()
+    # 'g.m.b.h.' -> 'gmbh' before punctuation is replaced by spaces
+    name = re.sub(r"(?<=\b\w)\.(?=\w\b)", "", name)
+    tokens = NON_ALPHANUMERIC.sub(" ", name).split()
+    stripped = [token for token in tokens if token not in LEGAL_FORMS]
+    return " ".join(stripped or tokens)
+
+
+# Function to split a normalized name into character n-grams
+def shingles(name: str, n: int = 3) -> set:
+    padded = f" {name} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i : i + n] for i in range(len(padded) - n + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class MinHash:
+    def __init__(self, n_bands: int = 16, rows_per_band: int = 4, seed: int = 0):
+        """
+        MinHash signatures with locality sensitive hashing (LSH) in bands.
+        Names whose shingle sets have Jaccard similarity s share at least one band
+        with probability 1 - (1 - s ** rows_per_band) ** n_bands.
+        """
+        self.n_bands = n_bands
+        self.rows_per_band = rows_per_band
+        rng = np.random.default_rng(seed)
+        n_hashes = n_bands * rows_per_band
+        self.a = rng.integers(1, PRIME, size=n_hashes, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, size=n_hashes, dtype=np.uint64)
+
+    def signature(self, items: set) -> np.ndarray:
+        # crc32 is stable across processes, so persisted buckets stay valid
+        x = np.array(
+            [zlib.crc32(item.encode("utf-8")) % PRIME for item in items],
+            dtype=np.uint64,
+        )
+        # (a * x + b) mod p for all hash functions at once
+        hashed = (self.a[:, None] * x[None, :] + self.b[:, None]) % np.uint64(PRIME)
+        return hashed.min(axis=1)
+
+    def buckets(self, items: set) -> list:
+        # one bucket key per band
+        signature = self.signature(items).reshape(self.n_bands, self.rows_per_band)
+        return [band.tobytes().hex() for band in signature]
+
+
+class EntityIndex:
+    def __init__(
+        self,
+        path: str,
+        threshold: float = 0.6,
+        n_bands: int = 16,
+        rows_per_band: int = 4,
+    ):
+        """
+        Persistent index of resolved names.
+        Normalized names are blocked with MinHash LSH; a name joins the entity of the most
+        similar candidate if the Jaccard similarity of their shingles reaches threshold,
+        otherwise it becomes a new entity. Entity ids are never reassigned, so ids stay
+        stable across harvests.
+
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite database, created if it does not exist
+        threshold : float
+            Minimum Jaccard similarity of the character 3-grams of two names of one entity
+        n_bands : int
+            Number of LSH bands
+        rows_per_band : int
+            Number of MinHash values per band
+        """
+        self.threshold = threshold
+        self.minhash = MinHash(n_bands, rows_per_band)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entities (
+                    entity_id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL
+                )
+                """
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS names (
+                    normalized_name TEXT PRIMARY KEY,
+                    entity_id INTEGER NOT NULL
+                )
+                """
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS buckets (
+                    band INTEGER NOT NULL,
+                    bucket TEXT NOT NULL,
+                    normalized_name TEXT NOT NULL,
+                    PRIMARY KEY (band, bucket, normalized_name)
+                )
+                """
+            )
+        # the index is held in memory, the database is only written to
+        self.names = dict(
+            self.connection.execute("SELECT normalized_name, entity_id FROM names")
+        )
+        self.buckets = dict()
+        for band, bucket, normalized_name in self.connection.execute(
+            "SELECT band, bucket, normalized_name FROM buckets"
+        ):
+            self.buckets.setdefault((band, bucket), []).append(normalized_name)
+        self.next_id = 1 + (
+            self.connection.execute("SELECT MAX(entity_id) FROM entities").fetchone()[0]
+            or 0
+        )
+
+    def __len__(self) -> int:
+        return self.next_id - 1
+
+    def _match(self, name_shingles: set, keys: list):
+        # entity of the most similar name sharing a bucket, None if none is similar enough
+        candidates = {
+            candidate
+            for band, bucket in enumerate(keys)
+            for candidate in self.buckets.get((band, bucket), [])
+        }
+        best, best_similarity = None, self.threshold
+        for candidate in candidates:
+            similarity = jaccard(name_shingles, shingles(candidate))
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        return None if best is None else self.names[best]
+
+    def resolve(self, names) -> list:
+        """
+        Return the entity ids of names, adding new names and entities to the index.
+        """
+        ids = []
+        new_names, new_entities, new_buckets = [], [], []
+        with self.lock:
+            for name in names:
+                normalized_name = normalize_name(name)
+                if normalized_name not in self.names:
+                    name_shingles = shingles(normalized_name)
+                    keys = self.minhash.buckets(name_shingles)
+                    entity_id = self._match(name_shingles, keys)
+                    if entity_id is None:
+                        entity_id = self.next_id
+                        self.next_id += 1
+                        new_entities.append((entity_id, name))
+                    self.names[normalized_name] = entity_id
+                    new_names.append((normalized_name, entity_id))
+                    for band, bucket in enumerate(keys):
+                        bucket_names = self.buckets.setdefault((band, bucket), [])
+                        bucket_names.append(normalized_name)
+                        new_buckets.append((band, bucket, normalized_name))
+                ids.append(self.names[normalized_name])
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO entities VALUES (?, ?)", new_entities
+                )
+                self.connection.executemany(
+                    "INSERT INTO names VALUES (?, ?)", new_names
+                )
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)", new_buckets
+                )
+        return ids
+
+    def entities(self) -> pd.DataFrame:
+        # entity ids and the first name seen of each entity
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT entity_id, name FROM entities ORDER BY entity_id"
+            ).fetchall()
+        return pd.DataFrame(rows, columns=["entity_id", "entity_name"])
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+# Function to count patents per entity, industry and year
+def entity_counts(
+    patents_df: pd.DataFrame, index: EntityIndex, column: str = "applicants"
+) -> pd.DataFrame:
+    """
+    Number of patents per resolved applicant (or inventor), industry and year
+    of the DataFrame returned by transform.tf_search_biblio.
+    Duplicates are dropped as in transform.prep_patents.
+
+    Parameters
+    ----------
+    patents_df : pd.DataFrame
+        DataFrame returned by transform.tf_search_biblio()
+    index : EntityIndex
+        Index the names are resolved with; new names are added
+    column : str
+        'applicants' or 'inventors'
+    """
+    patents_df = patents_df.drop_duplicates(subset=["query_industry", "document_id"])
+    names = patents_df[
+        ["query_industry", "document_date_year", "document_id", column]
+    ].explode(column)
+    names = names.dropna(subset=[column])
+    # resolve every distinct name once
+    unique_names = names[column].unique()
+    ids = dict(zip(unique_names, index.resolve(unique_names)))
+    names["entity_id"] = names[column].map(ids)
+    counts = (
+        names.groupby(["entity_id", "query_industry", "document_date_year"])[
+            "document_id"
+        ]
+        .nunique()
+        .reset_index(name="sum_patents")
+    )
+    return counts.merge(index.entities(), on="entity_id", how="left")
@@ -1,201 +1,463 @@
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from source.utils import gc_paused, loads, parse_lines, read_jsonl, read_lines
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# Function to normalize OPS values: single results are returned as dict instead of list
+def as_list(value) -> list:
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+# Function to look up a nested value, returns None if any key on the path is missing
+def get_path(element, path):
+    for key in path:
+        if not isinstance(element, dict):
+            return None
+        element = element.get(key)
+        if element is None:
+            return None
+    return element
+
+
+# Function to collect the exchange-document elements of a biblio-search or published-data biblio response
+# biblio-search wraps every document in its own exchange-documents entry, published-data biblio
+# may list several documents under a single exchange-documents element
+def get_documents(response) -> list:
+    data = response["ops:world-patent-data"]
+    if "ops:biblio-search" in data:
+        data = data["ops:biblio-search"]["ops:search-result"]
+    return [
+        element
+        for i in as_list(data.get("exchange-documents"))
+        for element in as_list(i["exchange-document"])
+    ]
+
+
 # Function to extract the content from the response
 def extract_search(
     response, country, industry, division, query, range_begin, range_end
 ) -> list:
-    # # Check if the response is empty
-    # if "<code>SERVER.EntityNotFound</code>" in response.text:
-    #     return None
-
-    # # Extract the content from the response
-    results = response.json()["ops:world-patent-data"]["ops:biblio-search"]["ops:search-result"]["ops:publication-reference"]
-    # TODO: Add new fields
+    # parse response only once, values shared by all results are taken out of the loop
+    search = loads(response.content)["ops:world-patent-data"]["ops:biblio-search"]
+    results = search["ops:search-result"]["ops:publication-reference"]
+    if not isinstance(results, (list, dict)):
+        return None
+    header = dict(response.headers)
+    total_results = search["@total-result-count"]
     ls = []
-    # Check if the response is a list or a dictionary (single result)
-    if isinstance(results, list):
-        for i in results:
-            data = {
-                "header": dict(response.headers),
+    for i in as_list(results):
+        document_id = i["document-id"]
+        document_country = document_id["country"]["$"]
+        document_number = document_id["doc-number"]["$"]
+        document_kind = document_id["kind"]["$"]
+        ls.append(
+            {
+                "header": header,
                 "country": country,
                 "industry": industry,
                 "division": division,
                 "query": query,
-                "total_results": response.json()["ops:world-patent-data"][
-                    "ops:biblio-search"
-                ]["@total-result-count"],
+                "total_results": total_results,
                 "range_begin": range_begin,
                 "range_end": range_end,
                 "family_id": i["@family-id"],
-                "document_id_type": i["document-id"]["@document-id-type"],
-                "document-id_country": i["document-id"]["country"]["$"],
-                "document-id_doc-number": i["document-id"]["doc-number"]["$"],
-                "document-id_kind": i["document-id"]["kind"]["$"],
-                "publication_number": i["document-id"]["country"]["$"]
-                + i["document-id"]["doc-number"]["$"]
-                + i["document-id"]["kind"]["$"],
+                "document_id_type": document_id["@document-id-type"],
+                "document-id_country": document_country,
+                "document-id_doc-number": document_number,
+                "document-id_kind": document_kind,
+                "publication_number": document_country + document_number + document_kind,
             }
-            ls.append(data)
-    elif isinstance(results, dict):
-        data = {
-            "header": dict(response.headers),
-            "country": country,
-            "industry": industry,
-            "division": division,
-            "query": query,
-            "total_results": response.json()["ops:world-patent-data"][
-                "ops:biblio-search"
-            ]["@total-result-count"],
-            "range_begin": range_begin,
-            "range_end": range_end,
-            "family_id": results["@family-id"],
-            "document_id_type": results["document-id"]["@document-id-type"],
-            "document-id_country": results["document-id"]["country"]["$"],
-            "document-id_doc-number": results["document-id"]["doc-number"]["$"],
-            "document-id_kind": results["document-id"]["kind"]["$"],
-            "publication_number": results["document-id"]["country"]["$"]
-            + results["document-id"]["doc-number"]["$"]
-            + results["document-id"]["kind"]["$"],
+        )
+    return ls
+
+
+# field extractors used by BIBLIO_SCHEMA, each receives the value found at the field's path
+def _publication_date(value):
+    document_ids = as_list(value)
+    return document_ids[0]["date"]["$"] if document_ids else None
+
+
+def _classifications(value):
+    return [
+        {
+            i["classification-scheme"]["@office"]: [
+                i["section"]["$"],
+                i["class"]["$"],
+                i["subclass"]["$"],
+                i["main-group"]["$"],
+                i["subgroup"]["$"],
+                i["classification-value"]["$"],
+                i["generating-office"]["$"],
+            ]
         }
-        ls.append(data)
-    else:
+        for i in as_list(value)
+    ]
+
+
+def _applicants(value):
+    # applicants in original format (not in epodoc format)
+    return [
+        i["applicant-name"]["name"]["$"]
+        for i in as_list(value)
+        if i["@data-format"] == "original"
+    ]
+
+
+def _inventors(value):
+    # inventors in original format (not in epodoc format)
+    if value is None:
         return None
-    return ls
+    return [
+        i["inventor-name"]["name"]["$"]
+        for i in as_list(value)
+        if i["@data-format"] == "original"
+    ]
+
+
+def _titles(value):
+    return [{i["@lang"]: i["$"]} for i in as_list(value) if i["@lang"] in ("en", "de")]
+
+
+def _citations(value):
+    # list of patent citations with tuples (document-id, name, date);
+    # if name and date are unavailable:  name/date = ""
+    # patcit = patent citation, sometimes there are other citations
+    if value is None:
+        return None
+    return [
+        (
+            j["doc-number"]["$"],
+            j["name"]["$"] if "name" in j else "",
+            j["date"]["$"] if "date" in j else "",
+        )
+        for i in as_list(value)
+        if "patcit" in i
+        for j in as_list(i["patcit"]["document-id"])
+        if j["@document-id-type"] == "epodoc"
+    ]
+
+
+def _abstract(value):
+    # english abstract, None if there is none
+    if value is None:
+        return None
+    for i in as_list(value):
+        if i["@lang"] == "en":
+            return i["p"]["$"]
+    return None
+
+
+# declarative schema of extracted fields: (field, path within exchange-document, extractor)
+# fields without extractor are copied as they are
+BIBLIO_SCHEMA = [
+    ("document_system", ("@system",), None),
+    ("document_family_id", ("@family-id",), None),
+    ("document_country", ("@country",), None),
+    ("document_doc-number", ("@doc-number",), None),
+    ("document_kind", ("@kind",), None),
+    (
+        "document_date",
+        ("bibliographic-data", "publication-reference", "document-id"),
+        _publication_date,
+    ),
+    (
+        "patent_classifications",
+        ("bibliographic-data", "patent-classifications", "patent-classification"),
+        _classifications,
+    ),
+    ("application-reference", ("bibliographic-data", "application-reference"), None),
+    ("priority-claims", ("bibliographic-data", "priority-claims"), None),
+    (
+        "applicants",
+        ("bibliographic-data", "parties", "applicants", "applicant"),
+        _applicants,
+    ),
+    (
+        "inventors",
+        ("bibliographic-data", "parties", "inventors", "inventor"),
+        _inventors,
+    ),
+    ("invention-title", ("bibliographic-data", "invention-title"), _titles),
+    (
+        "references_cited",
+        ("bibliographic-data", "references-cited", "citation"),
+        _citations,
+    ),
+    ("abstract", ("abstract",), _abstract),
+]
+
+
+# Function to extract a single exchange-document according to BIBLIO_SCHEMA
+def extract_document(element, schema=BIBLIO_SCHEMA) -> dict:
+    data = dict()
+    for field, path, extractor in schema:
+        value = get_path(element, path)
+        data[field] = value if extractor is None else extractor(value)
+    return data
 
 
 # Function to extract the content from the response
 def extract_biblio(json_object) -> list:
-    ls = []
+    with gc_paused():
+        return list(iter_biblio(json_object))
+
+
+# Function to stream extracted documents from a JSONL harvest file (see utils.JsonlWriter)
+def read_biblio(path):
+    return iter_biblio(read_jsonl(path))
+
+
+# Function to extract the documents of a JSON file holding a list of harvest records
+def load_biblio_json(path) -> list:
+    with gc_paused():
+        with open(path, "rb") as f:
+            return extract_biblio(loads(f.read()))
+
+
+# Function to load all extracted documents from a JSONL harvest file
+def load_biblio(path) -> list:
+    with gc_paused():
+        return list(read_biblio(path))
+
+
+# Generator yielding one extracted document at a time
+def iter_biblio(json_object):
+    for li in json_object:
+        # skip failed requests (see harvest.create_record)
+        if li.get("response") is None:
+            continue
+        # query fields are the same for all documents of a response
+        query = {
+            "query_country": li["country"],
+            "query_industry": li["industry"],
+            "query_division": li["division"],
+        }
+        for element in get_documents(li["response"]):
+            data = query.copy()
+            data.update(extract_document(element))
+            yield data
+
+
+# Generator yielding documents retrieved in batches by harvest.fetch_biblio()
+# documents are repeated for every (country, industry, division) whose queries returned them,
+# so the rows match those of extract_biblio()
+def iter_published_biblio(json_object, memberships: dict):
     for li in json_object:
-        documents = li["response"]["ops:world-patent-data"]["ops:biblio-search"][
-            "ops:search-result"
-        ]["exchange-documents"]
-        # check if documents is a list or a dictionary (only one result)
-        if isinstance(documents, dict):
-            documents = [documents]
-        for i in documents:
-            data = dict()
-            data["query_country"] = li["country"]
-            data["query_industry"] = li["industry"]
-            data["query_division"] = li["division"]
-
-            # get individual patent document
-            element = i["exchange-document"]
-            data["document_system"] = element["@system"]
-            data["document_family_id"] = element["@family-id"]
-            data["document_country"] = element["@country"]
-            data["document_doc-number"] = element["@doc-number"]
-            data["document_kind"] = element["@kind"]
-            data["document_date"] = element["bibliographic-data"][
-                "publication-reference"
-            ]["document-id"][0]["date"]["$"]
-
-            # get list of classifications for each patent
-            if isinstance(
-                element["bibliographic-data"]["patent-classifications"][
-                    "patent-classification"
-                ],
-                list,
+        if li.get("response") is None:
+            continue
+        for element in get_documents(li["response"]):
+            document = extract_document(element)
+            publication_number = (
+                document["document_country"]
+                + document["document_doc-number"]
+                + document["document_kind"]
+            )
+            for country, industry, division in memberships.get(
+                publication_number, [(None, None, None)]
             ):
-                data["patent_classifications"] = [
-                    {
-                        i["classification-scheme"]["@office"]: [
-                            i["section"]["$"],
-                            i["class"]["$"],
-                            i["subclass"]["$"],
-                            i["main-group"]["$"],
-                            i["subgroup"]["$"],
-                            i["classification-value"]["$"],
-                            i["generating-office"]["$"],
-                        ]
-                    }
-                    for i in element["bibliographic-data"]["patent-classifications"][
-                        "patent-classification"
-                    ]
-                ]
-            else:
-                i = element["bibliographic-data"]["patent-classifications"][
-                    "patent-classification"
-                ]
-                data["patent_classifications"] = [
-                    {
-                        i["classification-scheme"]["@office"]: [
-                            i["section"]["$"],
-                            i["class"]["$"],
-                            i["subclass"]["$"],
-                            i["main-group"]["$"],
-                            i["subgroup"]["$"],
-                            i["classification-value"]["$"],
-                            i["generating-office"]["$"],
-                        ]
-                    }
-                ]
+                data = {
+                    "query_country": country,
+                    "query_industry": industry,
+                    "query_division": division,
+                }
+                data.update(document)
+                yield data
 
-            data["application-reference"] = element["bibliographic-data"][
-                "application-reference"
-            ]
-            data["priority-claims"] = element["bibliographic-data"]["priority-claims"]
-
-            # get applicants in original format (not in epodoc format)
-            data["applicants"] = [
-                i["applicant-name"]["name"]["$"]
-                for i in element["bibliographic-data"]["parties"]["applicants"][
-                    "applicant"
-                ]
-                if i["@data-format"] == "original"
-            ]
-            # get inventors in original format (not in epodoc format)
-            # check if inventors exist
-            if "inventors" in element["bibliographic-data"]["parties"].keys():
-                data["inventors"] = [
-                    i["inventor-name"]["name"]["$"]
-                    for i in element["bibliographic-data"]["parties"]["inventors"][
-                        "inventor"
-                    ]
-                    if i["@data-format"] == "original"
-                ]
-            else:
-                data["inventors"] = None
-            data["invention-title"] = [
-                {i["@lang"]: i["$"]}
-                for i in element["bibliographic-data"]["invention-title"]
-                if i["@lang"] == "en" or i["@lang"] == "de"
-            ]
 
-            # check if citation exists
-            if "references-cited" in element["bibliographic-data"].keys():
-                # check for single citation
-                if isinstance(
-                    element["bibliographic-data"]["references-cited"]["citation"], dict
-                ):
-                    element["bibliographic-data"]["references-cited"]["citation"] = [
-                        element["bibliographic-data"]["references-cited"]["citation"]
-                    ]
-                # create list of citations with tuples (document-id, name, date);
-                # if name and date are unavailable:  name/date = ""
-                data["references_cited"] = [
-                    (
-                        j["doc-number"]["$"],
-                        (j["name"]["$"] if "name" in j.keys() else ""),
-                        (j["date"]["$"] if "date" in j.keys() else ""),
+# Function run by the worker processes of extract_biblio_parallel
+def _extract_chunk(chunk: list) -> list:
+    # chunks of a JSONL file are raw lines, chunks of a JSON file parsed records
+    if len(chunk) > 0 and isinstance(chunk[0], bytes):
+        chunk = parse_lines(chunk)
+    with gc_paused():
+        return list(iter_biblio(chunk))
+
+
+def _read_chunks(path: str, chunk_size: int):
+    if path.endswith(".json"):
+        # legacy harvest files hold a single JSON list and have to be loaded at once
+        with open(path, "rb") as f:
+            records = loads(f.read())
+        for i in range(0, len(records), chunk_size):
+            yield records[i : i + chunk_size]
+    else:
+        lines = read_lines(path)
+        while True:
+            chunk = list(islice(lines, chunk_size))
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+
+def extract_biblio_parallel(path: str, chunk_size: int = 500, max_workers: int = None):
+    """
+    Generator extracting a harvest file in parallel across a process pool.
+    Rows are yielded in the same order as extract_biblio() would return them.
+    Raw lines are sent to the workers, so parsing is parallelized as well; at
+    most two chunks per worker are in flight, which bounds memory use.
+
+    Parameters
+    ----------
+    path : str
+        JSONL harvest file (optionally compressed) or legacy JSON file
+    chunk_size : int
+        Number of responses extracted per task
+    max_workers : int
+        Number of worker processes, defaults to the number of CPUs
+    """
+    max_workers = max_workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for chunk in _read_chunks(path, chunk_size):
+            pending.append(executor.submit(_extract_chunk, chunk))
+            # results are collected in submission order to keep the output deterministic
+            if len(pending) >= 2 * max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+# columnar output of extract_biblio, partitioned by query country and industry
+PARTITION_COLS = ["query_country", "query_industry"]
+CLASSIFICATION_FIELDS = [
+    "office",
+    "section",
+    "class",
+    "subclass",
+    "main_group",
+    "subgroup",
+    "value",
+    "generating_office",
+]
+
+
+def _check_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet output requires the 'pyarrow' package.")
+
+
+def biblio_schema():
+    # arrow schema of the rows returned by extract_biblio
+    _check_pyarrow()
+    string_list = pa.list_(pa.string())
+    return pa.schema(
+        [
+            ("query_country", pa.string()),
+            ("query_industry", pa.string()),
+            ("query_division", pa.string()),
+            ("document_system", pa.string()),
+            ("document_family_id", pa.string()),
+            ("document_country", pa.string()),
+            ("document_doc-number", pa.string()),
+            ("document_kind", pa.string()),
+            ("document_date", pa.date32()),
+            (
+                "patent_classifications",
+                pa.list_(
+                    pa.struct([(field, pa.string()) for field in CLASSIFICATION_FIELDS])
+                ),
+            ),
+            # nested OPS structures without fixed schema are kept as JSON strings
+            ("application-reference", pa.string()),
+            ("priority-claims", pa.string()),
+            ("applicants", string_list),
+            ("inventors", string_list),
+            (
+                "invention-title",
+                pa.list_(pa.struct([("lang", pa.string()), ("title", pa.string())])),
+            ),
+            (
+                "references_cited",
+                pa.list_(
+                    pa.struct(
+                        [
+                            ("doc_number", pa.string()),
+                            ("name", pa.string()),
+                            ("date", pa.string()),
+                        ]
                     )
-                    for i in element["bibliographic-data"]["references-cited"][
-                        "citation"
-                    ]
-                    if "patcit"
-                    in i.keys()  # patcit = patent citation, sometimes there are other citations
-                    for j in i["patcit"]["document-id"]
-                    if j["@document-id-type"] == "epodoc"
-                ]
-
-            else:
-                data["references_cited"] = None
-
-            # check if abstract exists
-            if "abstract" in element.keys():
-                if isinstance(element["abstract"], dict):
-                    element["abstract"] = [element["abstract"]]
-                for i in element["abstract"]:
-                    data["abstract"] = i["p"]["$"] if i["@lang"] == "en" else None
-            else:
-                data["abstract"] = None
-            ls.append(data)
-    return ls
+                ),
+            ),
+            ("abstract", pa.string()),
+        ]
+    )
+
+
+# Function to convert rows returned by extract_biblio into an arrow table
+def to_arrow(rows: list):
+    schema = biblio_schema()
+    columns = {field: [] for field in schema.names}
+    for row in rows:
+        for field in schema.names:
+            columns[field].append(row[field])
+    columns["document_date"] = pc.cast(
+        pc.strptime(pa.array(columns["document_date"], pa.string()), "%Y%m%d", "s"),
+        pa.date32(),
+    )
+    columns["patent_classifications"] = [
+        [
+            dict(zip(CLASSIFICATION_FIELDS, [office] + values))
+            for classification in classifications
+            for office, values in classification.items()
+        ]
+        for classifications in columns["patent_classifications"]
+    ]
+    for field in ["application-reference", "priority-claims"]:
+        columns[field] = [
+            None if value is None else json.dumps(value) for value in columns[field]
+        ]
+    columns["invention-title"] = [
+        [{"lang": lang, "title": title} for i in titles for lang, title in i.items()]
+        for titles in columns["invention-title"]
+    ]
+    columns["references_cited"] = [
+        None
+        if references is None
+        else [{"doc_number": i[0], "name": i[1], "date": i[2]} for i in references]
+        for references in columns["references_cited"]
+    ]
+    return pa.Table.from_arrays(
+        [pa.array(columns[field], schema.field(field).type) for field in schema.names],
+        schema=schema,
+    )
+
+
+def write_biblio_parquet(
+    rows, path: str, partition_cols: list = PARTITION_COLS, batch_size: int = 50000
+) -> None:
+    """
+    Write extracted documents to a Parquet dataset partitioned by query country and industry.
+
+    Parameters
+    ----------
+    rows : iterable
+        Rows returned by extract_biblio() or read_biblio()
+    path : str
+        Root directory of the dataset; new files are added to existing partitions
+    partition_cols : list
+        Columns used to partition the dataset
+    batch_size : int
+        Number of rows converted and written at once
+    """
+    _check_pyarrow()
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if len(batch) == 0:
+            break
+        pq.write_to_dataset(to_arrow(batch), root_path=path, partition_cols=partition_cols)
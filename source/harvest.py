@@ -0,0 +1,264 @@
+# module to harvest the constructed queries from OPS concurrently
+import logging
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from source.api import (
+    BIBLIO_BATCH_SIZE,
+    MAX_RESULTS,
+    get_total_results,
+    remaining_ranges,
+    valid_publication_numbers,
+)
+from source.extract import extract_search
+from source.manifest import DONE, FAILED
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# a single request to OPS: one query for one country, industry and division in a given range
+Job = namedtuple(
+    "Job", ["country", "industry", "division", "query", "range_begin", "range_end"]
+)
+
+
+def create_jobs(queries: dict, range_begin: int = 1, range_end: int = 100) -> list:
+    """
+    Create a list of jobs from the query dictionary returned by construct_query().
+
+    Parameters
+    ----------
+    queries : dict
+        Dictionary with structure {country:{industry:{division:[queries]}}}
+    range_begin : int
+        First result to retrieve for each query
+    range_end : int
+        Last result to retrieve for each query (max. 100 results per request)
+    """
+    jobs = []
+    for country in queries.keys():
+        for industry in queries[country].keys():
+            for division in queries[country][industry].keys():
+                for query in queries[country][industry][division]:
+                    jobs.append(
+                        Job(country, industry, division, query, range_begin, range_end)
+                    )
+    return jobs
+
+
+def create_record(job: Job, response) -> dict:
+    # record in the format expected by extract.extract_biblio()
+    return {
+        "country": job.country,
+        "industry": job.industry,
+        "division": job.division,
+        "query": job.query,
+        "range_begin": job.range_begin,
+        "range_end": job.range_end,
+        "status_code": response.status_code,
+        "response": response.json() if response.status_code == 200 else None,
+    }
+
+
+def harvest(
+    jobs: list,
+    Client,
+    endpoint: str = "biblio-search",
+    max_workers: int = 8,
+    paginate: bool = False,
+    max_results: int = MAX_RESULTS,
+    Manifest=None,
+    max_age_days: int = None,
+):
+    """
+    Run jobs concurrently and yield (job, response) tuples as they complete.
+    All workers share the connections and the rate limiter of one client, so the
+    number of workers only determines how many requests may wait for a response
+    at the same time.
+    If paginate is True, the remaining Range windows of each job are scheduled
+    in the same pool as soon as its first page reported @total-result-count.
+    If a manifest is passed, only missing, failed or outdated pages are requested
+    and the outcome of each request is recorded.
+
+    Parameters
+    ----------
+    jobs : list
+        List of jobs returned by create_jobs()
+    Client : OPSClient
+        Client shared by all workers, its pool_maxsize should be >= max_workers
+    endpoint : str
+        'search' or 'biblio-search'
+    max_workers : int
+        Number of worker threads
+    paginate : bool
+        Retrieve all pages of each job (up to max_results)
+    max_results : int
+        Number of results after which the pagination stops (OPS returns max. 2000)
+    Manifest : Manifest
+        Optional manifest of harvested pages to resume an interrupted harvest
+    max_age_days : int
+        Only refresh pages retrieved more than max_age_days ago (requires Manifest)
+    """
+    if Manifest is not None:
+        jobs = Manifest.pending(
+            jobs, max_age_days=max_age_days, paginate=paginate, max_results=max_results
+        )
+        logger.info(f"{len(jobs)} pages pending according to manifest.")
+    queue = deque(jobs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def submit(job):
+            return executor.submit(
+                Client.make_request,
+                query=job.query,
+                range_begin=job.range_begin,
+                range_end=job.range_end,
+                endpoint=endpoint,
+            )
+
+        futures = dict()
+        try:
+            while queue or futures:
+                # at most two requests per worker are in flight, so a consumer that
+                # stops early (closed generator, error, Ctrl-C) does not run the whole queue
+                while queue and len(futures) < 2 * max_workers:
+                    job = queue.popleft()
+                    futures[submit(job)] = job
+                # wait for completed requests, new pages may be added in the meantime
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = futures.pop(future)
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        logger.error(
+                            f"Request failed for {job.country}/{job.industry}/{job.division}: {e}"
+                        )
+                        if Manifest is not None:
+                            Manifest.record(job, status=FAILED)
+                        continue
+                    total_results = get_total_results(response)
+                    if Manifest is not None:
+                        # 404 (SERVER.EntityNotFound) means the query has no results
+                        Manifest.record(
+                            job,
+                            status=DONE if response.status_code in (200, 404) else FAILED,
+                            http_code=response.status_code,
+                            result_count=total_results,
+                            n_bytes=len(response.content),
+                        )
+                    # schedule remaining pages only once, i.e. for the first page of a job
+                    if paginate and job.range_begin == 1:
+                        page_size = job.range_end - job.range_begin + 1
+                        for range_begin, range_end in remaining_ranges(
+                            total_results,
+                            job.range_end,
+                            page_size=page_size,
+                            max_results=max_results,
+                        ):
+                            page = job._replace(
+                                range_begin=range_begin, range_end=range_end
+                            )
+                            if Manifest is not None and Manifest.is_done(
+                                page, max_age_days=max_age_days
+                            ):
+                                continue
+                            queue.append(page)
+                    yield job, response
+        finally:
+            # drop requests that have not started yet, running ones finish on exit
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def discover(jobs: list, Client, DocumentIndex, **kwargs):
+    """
+    Run jobs against the (cheaper) search endpoint and record which documents each query returned.
+    Yields (job, new) tuples, where new are the publication numbers not returned by any earlier query.
+    Bibliographic data then only has to be retrieved once per unique document.
+
+    Parameters
+    ----------
+    jobs : list
+        List of jobs returned by create_jobs()
+    Client : OPSClient
+        Client shared by all workers
+    DocumentIndex : DocumentIndex
+        Index of documents and (query -> document) memberships
+    kwargs
+        Passed to harvest(), e.g. max_workers, paginate or Manifest
+    """
+    for job, response in harvest(jobs, Client, endpoint="search", **kwargs):
+        if response.status_code != 200:
+            continue
+        rows = extract_search(
+            response,
+            country=job.country,
+            industry=job.industry,
+            division=job.division,
+            query=job.query,
+            range_begin=job.range_begin,
+            range_end=job.range_end,
+        )
+        yield job, DocumentIndex.add_search_results(job, rows)
+
+
+def fetch_biblio(
+    publication_numbers: list,
+    Client,
+    DocumentIndex=None,
+    batch_size: int = BIBLIO_BATCH_SIZE,
+    max_workers: int = 8,
+):
+    """
+    Retrieve bibliographic data in batches of up to 100 documents per request.
+    Yields records that extract.iter_published_biblio() turns into the rows of extract_biblio().
+
+    Parameters
+    ----------
+    publication_numbers : list
+        Publication numbers, e.g. DocumentIndex.unfetched() after discover();
+        numbers not in docdb format are skipped with a warning
+    Client : OPSClient
+        Client shared by all workers
+    DocumentIndex : DocumentIndex
+        Optional index in which retrieved documents are marked as fetched
+    batch_size : int
+        Number of documents per request (max. 100)
+    max_workers : int
+        Number of worker threads
+    """
+    publication_numbers = valid_publication_numbers(publication_numbers)
+    batches = [
+        publication_numbers[i : i + batch_size]
+        for i in range(0, len(publication_numbers), batch_size)
+    ]
+    queue = deque(batches)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()
+        try:
+            while queue or futures:
+                # bounded window of requests in flight, as in harvest()
+                while queue and len(futures) < 2 * max_workers:
+                    batch = queue.popleft()
+                    futures[executor.submit(Client.fetch_biblio, batch)] = batch
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = futures.pop(future)
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        logger.error(
+                            f"Biblio request failed for {batch[0]}..{batch[-1]}: {e}"
+                        )
+                        continue
+                    if response.status_code == 200 and DocumentIndex is not None:
+                        DocumentIndex.mark_fetched(batch)
+                    yield {
+                        "publication_numbers": batch,
+                        "status_code": response.status_code,
+                        "response": response.json()
+                        if response.status_code == 200
+                        else None,
+                    }
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,159 @@
+# module to keep track of the query pages that have already been harvested
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+from source.api import MAX_RESULTS, remaining_ranges
+
+# statuses of a page; pages with status DONE are not requested again
+DONE = "done"
+FAILED = "failed"
+
+
+# Function to create a short, stable identifier for a query string
+def query_hash(query: str) -> str:
+    return hashlib.sha1(query.encode("utf-8")).hexdigest()
+
+
+class Manifest:
+    def __init__(self, path: str):
+        """
+        SQLite manifest of harvested query pages.
+        Each page is identified by the query hash, country, industry, division and range.
+
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite database, created if it does not exist
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pages (
+                    query_hash TEXT NOT NULL,
+                    country TEXT NOT NULL,
+                    industry TEXT NOT NULL,
+                    division TEXT NOT NULL,
+                    range_begin INTEGER NOT NULL,
+                    range_end INTEGER NOT NULL,
+                    query TEXT,
+                    status TEXT,
+                    http_code INTEGER,
+                    result_count INTEGER,  -- @total-result-count of the query
+                    n_bytes INTEGER,
+                    updated_at TEXT,
+                    PRIMARY KEY (query_hash, country, industry, division, range_begin, range_end)
+                )
+                """
+            )
+
+    @staticmethod
+    def _key(job) -> tuple:
+        return (
+            query_hash(job.query),
+            job.country,
+            job.industry,
+            job.division,
+            job.range_begin,
+            job.range_end,
+        )
+
+    @staticmethod
+    def _cutoff(max_age_days) -> str:
+        # pages updated before the cutoff are treated as missing
+        if max_age_days is None:
+            return ""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+        return cutoff.isoformat()
+
+    def record(
+        self, job, status, http_code=None, result_count=None, n_bytes=None
+    ) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self._key(job)
+                + (
+                    job.query,
+                    status,
+                    http_code,
+                    result_count,
+                    n_bytes,
+                    datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+
+    def get(self, job):
+        # returns (status, http_code, result_count, n_bytes, updated_at) or None
+        with self.lock:
+            return self.connection.execute(
+                """
+                SELECT status, http_code, result_count, n_bytes, updated_at FROM pages
+                WHERE query_hash = ? AND country = ? AND industry = ? AND division = ?
+                AND range_begin = ? AND range_end = ?
+                """,
+                self._key(job),
+            ).fetchone()
+
+    def is_done(self, job, max_age_days=None) -> bool:
+        row = self.get(job)
+        return row is not None and row[0] == DONE and row[4] >= self._cutoff(max_age_days)
+
+    def pending(
+        self, jobs: list, max_age_days=None, paginate=False, max_results=MAX_RESULTS
+    ) -> list:
+        """
+        Return the jobs that are missing, failed or older than max_age_days.
+
+        Parameters
+        ----------
+        jobs : list
+            List of jobs returned by harvest.create_jobs()
+        max_age_days : int
+            Only refresh pages retrieved more than max_age_days ago; None keeps all completed pages
+        paginate : bool
+            Also return the missing follow-up pages of completed first pages
+        max_results : int
+            Number of results after which the pagination stops
+        """
+        pending = []
+        for job in jobs:
+            row = self.get(job)
+            if row is None or row[0] != DONE or row[4] < self._cutoff(max_age_days):
+                pending.append(job)
+            elif paginate and job.range_begin == 1 and row[2] is not None:
+                # first page is complete; check the pages its result count requires
+                for range_begin, range_end in remaining_ranges(
+                    row[2],
+                    job.range_end,
+                    page_size=job.range_end - job.range_begin + 1,
+                    max_results=max_results,
+                ):
+                    page = job._replace(range_begin=range_begin, range_end=range_end)
+                    if not self.is_done(page, max_age_days=max_age_days):
+                        pending.append(page)
+        return pending
+
+    def summary(self) -> dict:
+        # number of pages, results and bytes by status
+        # every page stores the total of its query, so results are taken from first pages only
+        with self.lock:
+            rows = self.connection.execute(
+                """
+                SELECT status, COUNT(*),
+                SUM(CASE WHEN range_begin = 1 THEN result_count END), SUM(n_bytes)
+                FROM pages GROUP BY status
+                """
+            ).fetchall()
+        return {
+            status: {"pages": pages, "results": results, "bytes": n_bytes}
+            for status, pages, results, n_bytes in rows
+        }
+
+    def close(self) -> None:
+        self.connection.close()
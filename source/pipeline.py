@@ -0,0 +1,291 @@
+# module to cache the stages of the analysis (extract -> transform -> statsvis) on disk
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import sys
+
+import numpy as np
+import pandas as pd
+
+from source.utils import gc_paused
+
+try:
+    import pyarrow  # noqa: F401
+except ImportError:
+    pyarrow = None
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class File:
+    def __init__(self, path: str):
+        """
+        Input file of a stage. The file is hashed by its content,
+        so a stage reruns when the file changes.
+        """
+        self.path = path
+
+    def __fspath__(self) -> str:
+        return self.path
+
+    def __repr__(self) -> str:
+        return f"File({self.path!r})"
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def function_hash(func) -> str:
+    """
+    Changes whenever the code of the function, of its module or of the modules of the same
+    package its module uses changes, so edits to helpers called by func (e.g. detrend_groups
+    called by transform.prep_data) invalidate the stage.
+    Code outside the package (libraries, data files read by func) is not hashed,
+    bump the version of the stage when it changes.
+    """
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = ""
+    name = f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+    digest = hashlib.sha256(f"{name}\n{source}".encode("utf-8"))
+    module = sys.modules.get(getattr(func, "__module__", None) or "")
+    if module is not None:
+        for module_name, module_source in sorted(_module_sources(module, dict()).items()):
+            digest.update(f"{module_name}\n{module_source}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _module_sources(module, sources: dict) -> dict:
+    # source of module and, transitively, of the modules of its package it refers to
+    try:
+        sources[module.__name__] = inspect.getsource(module)
+    except (OSError, TypeError):
+        sources[module.__name__] = ""
+    package = module.__name__.partition(".")[0]
+    for value in list(vars(module).values()):
+        if inspect.ismodule(value):
+            dependency = value
+        else:
+            dependency = sys.modules.get(getattr(value, "__module__", None) or "")
+        if (
+            dependency is not None
+            and dependency.__name__.partition(".")[0] == package
+            and dependency.__name__ not in sources
+        ):
+            _module_sources(dependency, sources)
+    return sources
+
+
+class Stage:
+    def __init__(
+        self,
+        pipeline,
+        name: str,
+        key: str,
+        func,
+        args: tuple,
+        kwargs: dict,
+        version: str = "",
+    ):
+        """
+        Lazy output of a stage. The output is loaded from the cache or computed on first
+        access of value, so cached stages that are only inputs of other cached stages
+        are never read from disk.
+        """
+        self.pipeline = pipeline
+        self.name = name
+        self.key = key
+        self.version = version
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.loaded = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self.loaded:
+            self._value = self.pipeline._evaluate(self)
+            self.loaded = True
+        return self._value
+
+    def __repr__(self) -> str:
+        return f"Stage({self.name!r}, key={self.key!r})"
+
+
+class Pipeline:
+    def __init__(self, directory: str, enabled: bool = True):
+        """
+        Stage graph whose outputs are cached on disk.
+        Each stage is keyed by the hash of its function's code (see function_hash), its
+        version, its parameters and the keys of the stages it reads from, so only stages
+        with changed inputs are recomputed. Changes the key cannot see, e.g. to a library
+        or to code outside the function's package, require bumping the stage's version.
+        DataFrames are stored as Parquet (pickle without pyarrow), arrays as .npy and
+        everything else as pickle.
+
+        Parameters
+        ----------
+        directory : str
+            Directory holding the cached stage outputs
+        enabled : bool
+            Recompute every stage without reading or writing the cache
+        """
+        self.directory = directory
+        self.enabled = enabled
+        self.keys = dict()  # id(output) -> (key, output) of the stages run so far
+        self.stages = dict()  # name -> (key, cached)
+        os.makedirs(directory, exist_ok=True)
+
+    def _hash_value(self, value, digest) -> None:
+        # outputs of earlier stages are identified by their stage key
+        if isinstance(value, Stage):
+            digest.update(value.key.encode("utf-8"))
+        elif id(value) in self.keys and self.keys[id(value)][1] is value:
+            digest.update(self.keys[id(value)][0].encode("utf-8"))
+        elif isinstance(value, File):
+            digest.update(file_hash(value.path).encode("utf-8"))
+        elif _is_panel_index(value):
+            # the index is derived from its DataFrame, usually the output of an earlier stage;
+            # its pickle differs between a computed and a loaded DataFrame
+            digest.update(b"PanelIndex")
+            self._hash_value(value.df, digest)
+        elif isinstance(value, pd.DataFrame):
+            digest.update(pickle.dumps(list(value.columns)))
+            digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+        elif isinstance(value, np.ndarray) and value.dtype == object:
+            self._hash_value(value.tolist(), digest)
+        elif isinstance(value, np.ndarray):
+            digest.update(str((value.dtype, value.shape)).encode("utf-8"))
+            digest.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (list, tuple)):
+            digest.update(f"{type(value).__name__}{len(value)}".encode("utf-8"))
+            for item in value:
+                self._hash_value(item, digest)
+        elif isinstance(value, dict):
+            digest.update(f"dict{len(value)}".encode("utf-8"))
+            for key in sorted(value, key=repr):
+                self._hash_value(key, digest)
+                self._hash_value(value[key], digest)
+        else:
+            digest.update(pickle.dumps(value))
+
+    def key(self, name: str, func, args: tuple, kwargs: dict, version: str = "") -> str:
+        digest = hashlib.sha256()
+        digest.update(name.encode("utf-8"))
+        digest.update(function_hash(func).encode("utf-8"))
+        digest.update(str(version).encode("utf-8"))
+        self._hash_value(list(args), digest)
+        self._hash_value(kwargs, digest)
+        return digest.hexdigest()[:20]
+
+    def _path(self, name: str, key: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{name}-{key}{suffix}")
+
+    def _load(self, name: str, key: str):
+        # return (True, output) if the stage is cached, (False, None) otherwise
+        path = self._path(name, key, ".parquet")
+        if os.path.exists(path):
+            return True, pd.read_parquet(path)
+        path = self._path(name, key, ".npy")
+        if os.path.exists(path):
+            return True, np.load(path, allow_pickle=False)
+        path = self._path(name, key, ".pkl")
+        if os.path.exists(path):
+            with open(path, "rb") as f, gc_paused():
+                return True, pickle.load(f)
+        return False, None
+
+    def _store(self, name: str, key: str, output) -> None:
+        if (
+            isinstance(output, pd.DataFrame)
+            and pyarrow is not None
+            and _roundtrips(output)
+        ):
+            path = self._path(name, key, ".parquet")
+            output.to_parquet(path + ".tmp", index=True)
+        elif isinstance(output, np.ndarray) and output.dtype != object:
+            path = self._path(name, key, ".npy")
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, output, allow_pickle=False)
+        else:
+            path = self._path(name, key, ".pkl")
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+        # outputs of earlier runs of the stage are no longer needed
+        for file_name in os.listdir(self.directory):
+            stage, _, rest = file_name.rpartition("-")
+            if stage == name and not rest.startswith(key):
+                os.remove(os.path.join(self.directory, file_name))
+
+    def stage(self, name: str, func, *args, version: str = "", **kwargs) -> Stage:
+        """
+        Define stage name as func(*args, **kwargs) without running it.
+        Other stages, outputs of earlier stages and File inputs may be passed as arguments.
+        version is not passed to func; bump it to recompute the stage after changes
+        function_hash does not cover.
+        """
+        key = self.key(name, func, args, kwargs, version)
+        return Stage(self, name, key, func, args, kwargs, version)
+
+    def run(self, name: str, func, *args, version: str = "", **kwargs):
+        # run the stage and return its output
+        return self.stage(name, func, *args, version=version, **kwargs).value
+
+    def _evaluate(self, stage: Stage):
+        cached, output = (
+            self._load(stage.name, stage.key) if self.enabled else (False, None)
+        )
+        if cached:
+            logger.info(f"Stage {stage.name}: loaded from cache")
+        else:
+            logger.info(f"Stage {stage.name}: computing")
+            output = stage.func(
+                *[_unwrap(value) for value in stage.args],
+                **{argument: _unwrap(value) for argument, value in stage.kwargs.items()},
+            )
+            if self.enabled:
+                self._store(stage.name, stage.key, output)
+        self.keys[id(output)] = (stage.key, output)
+        self.stages[stage.name] = (stage.key, cached)
+        return output
+
+    def summary(self) -> pd.DataFrame:
+        # key of each stage and whether it was loaded from the cache
+        return pd.DataFrame(
+            [(name, key, cached) for name, (key, cached) in self.stages.items()],
+            columns=["Stage", "Key", "Cached"],
+        )
+
+
+def _unwrap(value):
+    if isinstance(value, Stage):
+        return value.value
+    return value.path if isinstance(value, File) else value
+
+
+def _is_panel_index(value) -> bool:
+    # statsvis is only imported by callers that can pass a PanelIndex
+    statsvis = sys.modules.get("source.statsvis")
+    return statsvis is not None and isinstance(value, statsvis.PanelIndex)
+
+
+def _roundtrips(df: pd.DataFrame) -> bool:
+    # Parquet needs string column names; lists and mixed types in object columns do not survive
+    if not all(isinstance(column, str) for column in df.columns):
+        return False
+    return all(
+        df[column].dropna().map(type).isin([str]).all()
+        for column in df.columns
+        if df[column].dtype == object
+    )
@@ -0,0 +1,108 @@
+# resampling inference for the coefficients fitted by statsvis.run_regressions()
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from source.statsvis import stack_cells
+
+
+# indices of moving block bootstrap samples, shape (n_replicates, n)
+def block_indices(rng, n: int, n_replicates: int, block_length: int) -> np.ndarray:
+    block_length = min(block_length, n)
+    n_blocks = -(-n // block_length)  # ceiling division
+    starts = rng.integers(0, n - block_length + 1, size=(n_replicates, n_blocks))
+    indices = starts[:, :, None] + np.arange(block_length)[None, None, :]
+    return indices.reshape(n_replicates, -1)[:, :n]
+
+
+def _resample_cell(X, y, term, n_replicates, block_length, seed):
+    """
+    Block bootstrap and permutation test for one cell, vectorized across replicates.
+    Runs in the worker processes of resample_regressions().
+    """
+    rng = np.random.default_rng(seed)
+    n = len(y)
+    X_pinv = np.linalg.pinv(X)
+    coef = X_pinv[term] @ y
+
+    # moving block bootstrap of (x, y) pairs keeps the serial correlation within blocks
+    indices = block_indices(rng, n, n_replicates, block_length)
+    X_boot = X[indices]  # (replicates, n, k)
+    y_boot = y[indices]
+    boot = np.einsum("rn,rn->r", np.linalg.pinv(X_boot)[:, term, :], y_boot)
+
+    # permutation test (Freedman-Lane): permute residuals of the model without the term
+    X_reduced = np.delete(X, term, axis=1)
+    fitted = X_reduced @ (np.linalg.pinv(X_reduced) @ y)
+    resid = y - fitted
+    permutations = rng.permuted(np.tile(np.arange(n), (n_replicates, 1)), axis=1)
+    y_perm = fitted[None, :] + resid[permutations]
+    perm = y_perm @ X_pinv[term]
+
+    return {
+        "Coef.": coef,
+        "Bootstrap SE": boot.std(ddof=1),
+        "CI lower": np.quantile(boot, 0.025),
+        "CI upper": np.quantile(boot, 0.975),
+        # share of centered bootstrap coefficients at least as extreme as the estimate
+        "Bootstrap p": np.mean(np.abs(boot - coef) >= np.abs(coef)),
+        "Permutation p": (1 + np.sum(np.abs(perm) >= np.abs(coef))) / (n_replicates + 1),
+        "Observations": n,
+    }
+
+
+def resample_regressions(
+    data,
+    industries,
+    indicators,
+    x_cols,
+    term="Sum patents",
+    n_replicates=10000,
+    block_length=2,
+    seed=0,
+    max_workers=None,
+) -> pd.DataFrame:
+    """
+    Block bootstrap and permutation inference for one coefficient in every industry x indicator cell.
+    Cells are spread over a process pool; each cell gets its own seed spawned from seed,
+    so the results do not depend on the number of workers.
+
+    PARAMS
+    ------
+    data: pd.DataFrame
+        DataFrame returned by transform.prep_data()
+    industries: list
+        NACE codes of the industries
+    indicators: list
+        Indicators
+    x_cols: list
+        Regressors of the model (a constant is added)
+    term: str
+        Regressor whose coefficient is tested
+    n_replicates: int
+        Number of bootstrap samples and permutations per cell
+    block_length: int
+        Length of the blocks of consecutive years in the moving block bootstrap
+    seed: int
+        Seed of the random number generators
+    max_workers: int
+        Number of worker processes, defaults to the number of CPUs
+    """
+    keys, X, y, nobs = stack_cells(data, industries, indicators, x_cols)
+    term_index = 1 + list(x_cols).index(term)  # column 0 is the constant
+    seeds = np.random.SeedSequence(seed).spawn(len(keys))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(
+            executor.map(
+                _resample_cell,
+                [X[i, : nobs[i]] for i in range(len(keys))],
+                [y[i, : nobs[i]] for i in range(len(keys))],
+                [term_index] * len(keys),
+                [n_replicates] * len(keys),
+                [block_length] * len(keys),
+                seeds,
+            )
+        )
+    index = pd.MultiIndex.from_tuples(keys, names=["Industry", "Indicator"])
+    return pd.DataFrame(results, index=index)
@@ -5,18 +5,49 @@ from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
-from statsmodels.stats.stattools import durbin_watson, jarque_bera
 from statsmodels.stats.diagnostic import het_breuschpagan
+from scipy import sparse, stats
 
 FLOAT_FORMAT = "%.4f"
 
 
+# panel structure built once from the output of transform.prep_data()
+# groups are stored as row positions, per-group aggregates are precomputed
+class PanelIndex:
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.nace = df.groupby("NACE", sort=False).indices
+        self.indicator = df.groupby("Indicator", sort=False).indices
+        self.cells = df.groupby(["NACE", "Indicator"], sort=False).indices
+        self.cell_size = df.groupby(["NACE", "Indicator"], sort=False).size()
+        # patents are repeated for every indicator: one row per industry and year
+        per_year = df.drop_duplicates(subset=["NACE", "Year"])
+        nace_patents = per_year.groupby("NACE", sort=False)["Sum patents"]
+        self.nace_sum = nace_patents.sum()
+        self.nace_count = nace_patents.count()
+        self.nace_years = (
+            per_year[per_year["Year"] != 0].groupby("NACE", sort=False)["Year"].count()
+        )
+        indicator_patents = df.groupby("Indicator", sort=False)["Sum patents"]
+        self.indicator_sum = indicator_patents.sum()
+        self.indicator_count = indicator_patents.count()
+
+    def group(self, by: str, value) -> pd.DataFrame:
+        # rows of one industry ('NACE') or indicator ('Indicator')
+        groups = self.nace if by == "NACE" else self.indicator
+        return self.df.iloc[groups[value]]
+
+    def cell(self, nace, indicator) -> pd.DataFrame:
+        return self.df.iloc[self.cells[(nace, indicator)]]
+
+
 # run regressions and save results in dict
-def run_regressions(data, industries, indicators, x_cols, successive=True):
+def run_regressions(data, industries, indicators, x_cols, successive=True, panel=None):
+    panel = panel or PanelIndex(data)
     results = dict()
     for industry in industries:
         for indicator in indicators:
-            tmp_df = data[(data["NACE"] == industry) & (data["Indicator"] == indicator)]
+            tmp_df = panel.cell(industry, indicator)
             sub_results = []
             if successive:
                 for i in range(0, len(x_cols)):
@@ -38,6 +69,271 @@ def run_regressions(data, industries, indicators, x_cols, successive=True):
     return results
 
 
+# group data once and stack the design matrices of all industry x indicator cells
+# into zero padded 3-D arrays; zero rows do not change X'X or X'y
+def stack_cells(data, industries, indicators, x_cols, y_col="OBS_VALUE"):
+    groups = data.groupby(["NACE", "Indicator"], sort=False).indices
+    keys = [
+        (industry, indicator)
+        for industry in industries
+        for indicator in indicators
+        if (industry, indicator) in groups
+    ]
+    nobs = np.array([len(groups[key]) for key in keys])
+    n_max = nobs.max() if len(keys) > 0 else 0
+    x_values = data[x_cols].to_numpy(dtype=float)
+    y_values = data[y_col].to_numpy(dtype=float)
+    X = np.zeros((len(keys), n_max, len(x_cols) + 1))
+    y = np.zeros((len(keys), n_max))
+    for i, key in enumerate(keys):
+        rows = groups[key]
+        X[i, : len(rows), 0] = 1.0  # constant
+        X[i, : len(rows), 1:] = x_values[rows]
+        y[i, : len(rows)] = y_values[rows]
+    return keys, X, y, nobs
+
+
+# solve OLS for all stacked cells at once
+def batched_ols(X, y, nobs) -> dict:
+    # SVD based pseudo-inverse of X avoids squaring the condition number of X'X
+    X_pinv = np.linalg.pinv(X)
+    xtx_inv = np.einsum("cin,cjn->cij", X_pinv, X_pinv)
+    params = np.einsum("cin,cn->ci", X_pinv, y)
+    resid = y - np.einsum("cni,ci->cn", X, params)
+    ssr = np.einsum("cn,cn->c", resid, resid)
+    rank = np.linalg.matrix_rank(X)
+    df_resid = nobs - rank
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = np.where(df_resid > 0, ssr / df_resid, np.nan)
+        bse = np.sqrt(np.einsum("cii->ci", xtx_inv) * scale[:, None])
+        tvalues = params / bse
+        pvalues = 2 * stats.t.sf(np.abs(tvalues), df_resid[:, None])
+        # centered total sum of squares, padded rows are excluded via the mask
+        mask = np.arange(y.shape[1])[None, :] < nobs[:, None]
+        y_mean = y.sum(axis=1) / nobs
+        centered_tss = (((y - y_mean[:, None]) * mask) ** 2).sum(axis=1)
+        rsquared = 1 - ssr / centered_tss
+    return {
+        "params": params,
+        "bse": bse,
+        "tvalues": tvalues,
+        "pvalues": pvalues,
+        "nobs": nobs,
+        "df_resid": df_resid,
+        "rsquared": rsquared,
+        "resid": resid,
+    }
+
+
+def run_regressions_batched(
+    data, industries, indicators, x_cols, successive=True, return_models=False
+):
+    """
+    Fit the regressions of run_regressions() for all industries and indicators at once.
+    Returns a table with one row per industry, indicator, model and term; with
+    return_models=True the statsmodels results of run_regressions() are returned as well.
+
+    PARAMS
+    ------
+    data: pd.DataFrame
+        DataFrame returned by transform.prep_data()
+    industries: list
+        NACE codes of the industries to fit
+    indicators: list
+        Indicators to fit
+    x_cols: list
+        Regressors; with successive=True one model per prefix of x_cols is fitted
+    return_models: bool
+        Also return the dict of statsmodels results returned by run_regressions()
+    """
+    specs = [x_cols[: i + 1] for i in range(len(x_cols))] if successive else [x_cols]
+    tables = []
+    for model, exogenous in enumerate(specs):
+        keys, X, y, nobs = stack_cells(data, industries, indicators, exogenous)
+        res = batched_ols(X, y, nobs)
+        terms = ["const"] + list(exogenous)
+        index = pd.MultiIndex.from_tuples(
+            [
+                (industry, indicator, model, term)
+                for industry, indicator in keys
+                for term in terms
+            ],
+            names=["Industry", "Indicator", "Model", "Term"],
+        )
+        tables.append(
+            pd.DataFrame(
+                {
+                    "Coef.": res["params"].ravel(),
+                    "Std.Err.": res["bse"].ravel(),
+                    "t": res["tvalues"].ravel(),
+                    "P>|t|": res["pvalues"].ravel(),
+                    "Observations": np.repeat(res["nobs"], len(terms)),
+                    "R-squared": np.repeat(res["rsquared"], len(terms)),
+                },
+                index=index,
+            )
+        )
+    table = pd.concat(tables).sort_index(
+        level=["Industry", "Indicator"], sort_remaining=False
+    )
+    if return_models:
+        return table, run_regressions(data, industries, indicators, x_cols, successive)
+    return table
+
+
+# subtract group means of every set of fixed effects, alternating until convergence
+# (a single pass is exact for one set of fixed effects and for balanced panels)
+def within_transform(values, groups: list, tol=1e-10, max_iter=1000):
+    n = len(values)
+    dummies = [
+        sparse.csr_matrix(
+            (np.ones(n), (np.arange(n), codes)), shape=(n, codes.max() + 1)
+        )
+        for codes in groups
+    ]
+    counts = [np.asarray(dummy.sum(axis=0)).ravel()[:, None] for dummy in dummies]
+    values = np.array(values, dtype=float)
+    scale = np.maximum(np.abs(values).max(axis=0), 1.0)
+    for _ in range(max_iter):
+        previous = values.copy()
+        for dummy, count in zip(dummies, counts):
+            values -= dummy @ ((dummy.T @ values) / count)
+        change = np.abs(values - previous).max(axis=0)
+        if len(dummies) == 1 or np.all(change < tol * scale):
+            break
+    return values
+
+
+def run_panel_regressions(
+    data,
+    industries,
+    indicators,
+    x_cols,
+    entity="Country",
+    time_effects=True,
+    cov_type="cluster",
+    y_col="OBS_VALUE",
+):
+    """
+    Fixed-effects panel regressions for all industry x indicator cells at once,
+    on the country x industry x year panel of transform.prep_data(by_country=True).
+    Entity (and year) fixed effects are absorbed by a within-transformation over
+    sparse dummies, then every cell is solved from its own normal equations.
+    Returns a table with one row per industry, indicator and term.
+
+    PARAMS
+    ------
+    data: pd.DataFrame
+        DataFrame returned by transform.prep_data(by_country=True)
+    industries: list
+        NACE codes of the industries to fit
+    indicators: list
+        Indicators to fit
+    x_cols: list
+        Regressors (without constant, it is absorbed by the fixed effects)
+    entity: str
+        Column of the panel entities, e.g. 'Country'
+    time_effects: bool
+        Also absorb year fixed effects (two-way fixed effects)
+    cov_type: str
+        'cluster' for standard errors clustered by entity, 'nonrobust' otherwise
+    """
+    if cov_type not in ["cluster", "nonrobust"]:
+        raise ValueError("Argument cov_type either cluster or nonrobust")
+    data = data[data["NACE"].isin(industries) & data["Indicator"].isin(indicators)]
+    data = data.dropna(subset=[y_col] + list(x_cols))
+    cell = data.groupby(["NACE", "Indicator"], sort=True).ngroup().to_numpy()
+    keys = list(data.groupby(["NACE", "Indicator"], sort=True).groups.keys())
+    n_cells, k = len(keys), len(x_cols)
+    # fixed effects are nested within cells, so all cells are transformed together
+    entities = data.groupby(["NACE", "Indicator", entity], sort=True).ngroup().to_numpy()
+    groups = [entities]
+    if time_effects:
+        groups.append(data.groupby(["NACE", "Indicator", "Year"]).ngroup().to_numpy())
+    values = within_transform(
+        data[[y_col] + list(x_cols)].to_numpy(dtype=float), groups
+    )
+    y, X = values[:, 0], values[:, 1:]
+    # per-cell normal equations X'X and X'y
+    xtx = np.empty((n_cells, k, k))
+    xty = np.empty((n_cells, k))
+    for i in range(k):
+        xty[:, i] = np.bincount(cell, weights=X[:, i] * y, minlength=n_cells)
+        for j in range(k):
+            xtx[:, i, j] = np.bincount(
+                cell, weights=X[:, i] * X[:, j], minlength=n_cells
+            )
+    xtx_inv = np.linalg.pinv(xtx)
+    params = np.einsum("cij,cj->ci", xtx_inv, xty)
+    resid = y - np.einsum("ri,ri->r", X, params[cell])
+    nobs = np.bincount(cell, minlength=n_cells)
+    ssr = np.bincount(cell, weights=resid**2, minlength=n_cells)
+    tss = np.bincount(cell, weights=y**2, minlength=n_cells)
+    # number of entities (and years) per cell, their fixed effects use degrees of freedom
+    entity_cell = np.zeros(entities.max() + 1, dtype=int)
+    entity_cell[entities] = cell
+    n_entities = np.bincount(entity_cell, minlength=n_cells)
+    n_effects = n_entities.copy()
+    # year dummies estimated besides the regressors and the constant
+    n_year_dummies = np.zeros(n_cells, dtype=int)
+    if time_effects:
+        year_cell = np.zeros(groups[1].max() + 1, dtype=int)
+        year_cell[groups[1]] = cell
+        n_year_dummies = np.bincount(year_cell, minlength=n_cells) - 1
+        n_effects += n_year_dummies
+    df_resid = nobs - k - n_effects
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if cov_type == "nonrobust":
+            scale = np.where(df_resid > 0, ssr / df_resid, np.nan)
+            cov = xtx_inv * scale[:, None, None]
+            df_t = df_resid
+        else:
+            # sum of scores per entity, meat = sum of their outer products per cell
+            scores = np.stack(
+                [
+                    np.bincount(
+                        entities, weights=X[:, i] * resid, minlength=len(entity_cell)
+                    )
+                    for i in range(k)
+                ],
+                axis=1,
+            )
+            meat = np.zeros((n_cells, k, k))
+            np.add.at(meat, entity_cell, scores[:, :, None] * scores[:, None, :])
+            # small sample correction of Stata's xtreg, fe vce(cluster): (G-1) and (N-K)
+            # with K counting the regressors, the constant and the year dummies,
+            # but not the entity effects, which are nested within the clusters
+            n_params = k + 1 + n_year_dummies
+            correction = n_entities / (n_entities - 1) * (nobs - 1) / (nobs - n_params)
+            cov = np.einsum("cij,cjk,ckl->cil", xtx_inv, meat, xtx_inv)
+            cov *= correction[:, None, None]
+            df_t = n_entities - 1
+        bse = np.sqrt(np.einsum("cii->ci", cov))
+        tvalues = params / bse
+        pvalues = 2 * stats.t.sf(np.abs(tvalues), df_t[:, None])
+        rsquared = 1 - ssr / tss
+    index = pd.MultiIndex.from_tuples(
+        [
+            (industry, indicator, term)
+            for industry, indicator in keys
+            for term in x_cols
+        ],
+        names=["Industry", "Indicator", "Term"],
+    )
+    return pd.DataFrame(
+        {
+            "Coef.": params.ravel(),
+            "Std.Err.": bse.ravel(),
+            "t": tvalues.ravel(),
+            "P>|t|": pvalues.ravel(),
+            "Observations": np.repeat(nobs, k),
+            "Entities": np.repeat(n_entities, k),
+            "R-squared (within)": np.repeat(rsquared, k),
+        },
+        index=index,
+    )
+
+
 # summarize results saved in dict returned from run_regression()
 def summarize_results(results, indicators, industries, by="indicator"):
     len_results_sublists = len(
@@ -148,54 +444,46 @@ def extract_pvalues(results, decimals=5, stars=True, threshold=0.05) -> list:
     return pvalues
 
 
-def sample_size(df: pd.DataFrame, by: str):
+def sample_size(df: pd.DataFrame, by: str, panel: PanelIndex = None):
+    panel = panel or PanelIndex(df)
     samples = dict()
-    samples["sum"] = dict()
-    samples["count"] = dict()
     if by == "nace":
-        for nace in df["NACE"].unique():
-            samples["sum"][nace] = [
-                int(
-                    df[df["NACE"] == nace]
-                    .drop_duplicates(subset="Year")["Sum patents"]
-                    .sum()
-                )
-            ]
-            samples["count"][nace] = [
-                int(
-                    df[df["NACE"] == nace]
-                    .drop_duplicates(subset="Year")["Sum patents"]
-                    .count()
-                )
-            ]
-    if by == "indicator":
-        for indicator in df["Indicator"].unique():
-            samples["sum"][indicator] = [
-                int(df[df["Indicator"] == indicator]["Sum patents"].sum())
-            ]
-            samples["count"][indicator] = [
-                int(df[df["Indicator"] == indicator]["Sum patents"].count())
-            ]
+        samples["sum"] = {nace: [int(v)] for nace, v in panel.nace_sum.items()}
+        samples["count"] = {nace: [int(v)] for nace, v in panel.nace_count.items()}
+    elif by == "indicator":
+        samples["sum"] = {i: [int(v)] for i, v in panel.indicator_sum.items()}
+        samples["count"] = {i: [int(v)] for i, v in panel.indicator_count.items()}
+    else:
+        samples["sum"] = dict()
+        samples["count"] = dict()
     return samples
 
 
 def extent_pvalues(
-    pvalues, prepped_df, sum_name="Patents (sum)", count_name="Sample size"
+    pvalues,
+    prepped_df,
+    sum_name="Patents (sum)",
+    count_name="Sample size",
+    panel: PanelIndex = None,
 ):
+    # sample sizes are read from one panel index
+    panel = panel or PanelIndex(prepped_df)
+    samples_indic = sample_size(prepped_df, by="indicator", panel=panel)
+    samples_nace = sample_size(prepped_df, by="nace", panel=panel)
     # create DataFrames holding sum of patents for industries and indicators
-    ss_indic = pd.DataFrame.from_dict(
-        sample_size(prepped_df, by="indicator")["sum"], orient="index"
-    ).rename(columns={0: sum_name})
-    ss_nace = pd.DataFrame.from_dict(
-        sample_size(prepped_df, by="nace")["sum"], orient="columns"
-    ).rename(index={0: sum_name})
+    ss_indic = pd.DataFrame.from_dict(samples_indic["sum"], orient="index").rename(
+        columns={0: sum_name}
+    )
+    ss_nace = pd.DataFrame.from_dict(samples_nace["sum"], orient="columns").rename(
+        index={0: sum_name}
+    )
     # create dataframes holdung sample count for industries and indicators
-    sc_indic = pd.DataFrame.from_dict(
-        sample_size(prepped_df, by="indicator")["count"], orient="index"
-    ).rename(columns={0: count_name})
-    sc_nace = pd.DataFrame.from_dict(
-        sample_size(prepped_df, by="nace")["count"], orient="columns"
-    ).rename(index={0: count_name})
+    sc_indic = pd.DataFrame.from_dict(samples_indic["count"], orient="index").rename(
+        columns={0: count_name}
+    )
+    sc_nace = pd.DataFrame.from_dict(samples_nace["count"], orient="columns").rename(
+        index={0: count_name}
+    )
     # merge dataframes along index and columns
     df = pd.concat([pvalues, ss_nace])
     df = pd.concat([df, sc_nace])
@@ -204,6 +492,29 @@ def extent_pvalues(
     return df
 
 
+# residual tests of several models at once; residuals are NaN padded to equal length
+def residual_diagnostics(resids: list) -> dict:
+    n_max = max(len(r) for r in resids)
+    r = np.full((len(resids), n_max), np.nan)
+    for i, resid in enumerate(resids):
+        r[i, : len(resid)] = resid
+    nobs = np.sum(~np.isnan(r), axis=1)
+    centered = r - np.nanmean(r, axis=1, keepdims=True)
+    m2 = np.nanmean(centered**2, axis=1)
+    # biased skew and (non-excess) kurtosis, as in statsmodels' jarque_bera
+    skew = np.nanmean(centered**3, axis=1) / m2**1.5
+    kurtosis = np.nanmean(centered**4, axis=1) / m2**2
+    jb = nobs / 6 * (skew**2 + (kurtosis - 3) ** 2 / 4)
+    return {
+        "Jarque-Bera": stats.chi2.sf(jb, 2),
+        "Skew": skew,
+        "Kurtosis": kurtosis,
+        # differences with a padded NaN are ignored by nansum
+        "Durbin-Watson": np.nansum(np.diff(r, axis=1) ** 2, axis=1)
+        / np.nansum(r**2, axis=1),
+    }
+
+
 def create_summary_statistics(results, cols, decimals=3, index=0) -> dict:
     """
     utility function to summarize main regression tests and key figures by industry
@@ -221,63 +532,55 @@ def create_summary_statistics(results, cols, decimals=3, index=0) -> dict:
     """
     summary_statistics = dict()
     for industry in results.keys():
-        industry_stats = None
-        for indicator in results[industry].keys():
-            res = results[industry][indicator][index]
+        indicators = list(results[industry].keys())
+        models = [results[industry][indicator][index] for indicator in indicators]
+        # residual tests are computed once for all models of the industry
+        diagnostics = residual_diagnostics([res.resid for res in models])
+        industry_stats = dict()
+        for j, (indicator, res) in enumerate(zip(indicators, models)):
+            conf_int = res.conf_int()
             data = {
                 "F-statistic": res.fvalue,
                 "Prob (F-statistic)": res.f_pvalue,
                 "Observations": res.nobs,
                 "R-squared": res.rsquared,
                 "Adj. R-squared": res.rsquared_adj,
-                "Jarque-Bera": jarque_bera(res.resid)[1],
-                "Skew": jarque_bera(res.resid)[2],
-                "Kurtosis": jarque_bera(res.resid)[3],
-                "Durbin-Watson": durbin_watson(res.resid),
+                "Jarque-Bera": diagnostics["Jarque-Bera"][j],
+                "Skew": diagnostics["Skew"][j],
+                "Kurtosis": diagnostics["Kurtosis"][j],
+                "Durbin-Watson": diagnostics["Durbin-Watson"][j],
                 "Breusch-Pagan": het_breuschpagan(
                     resid=res.resid, exog_het=res.model.exog
                 )[1],
             }
             for i in cols:
-                data[i + " Coef."] = res.pvalues[i]
+                data[i + " Coef."] = res.params[i]
                 data[i + " p value"] = res.pvalues[i]
                 data[i + " SE"] = res.bse[i]
-                data[i + " Conf. lower"] = res.conf_int().at[i, 0]
-                data[i + " Conf. upper"] = res.conf_int().at[i, 1]
-            series = pd.Series(data=data)
-            tmp_df = series.to_frame(name=indicator).round(3)
-            if industry_stats is None:
-                industry_stats = tmp_df
-            else:
-                industry_stats = industry_stats.merge(
-                    tmp_df, left_index=True, right_index=True
-                )
-                industry_stats = industry_stats.round(decimals)
-        summary_statistics[industry] = industry_stats
+                data[i + " Conf. lower"] = conf_int.at[i, 0]
+                data[i + " Conf. upper"] = conf_int.at[i, 1]
+            industry_stats[indicator] = data
+        # assemble the table of the industry at once
+        summary_statistics[industry] = pd.DataFrame(industry_stats).round(decimals)
     return summary_statistics
 
 
 # descriptives
-def descriptives(df):
+def descriptives(df, panel: PanelIndex = None):
+    panel = panel or PanelIndex(df)
     data = {
         "len_df": len(df),
         "num_industries": len(df["Industry"].unique()),
         "industries": list(df["Industry"].unique()),
         "num_indicators": len(df["Indicator"].unique()),
         "indicators": list(df["Indicator"].unique()),
-        "max_years": np.max(df.groupby(by=["NACE", "Indicator"]).size()),
-        "min_years": np.min(df.groupby(by=["NACE", "Indicator"]).size()),
-        "average_years": round(np.average(df.groupby(by=["NACE", "Indicator"]).size())),
+        "max_years": np.max(panel.cell_size),
+        "min_years": np.min(panel.cell_size),
+        "average_years": round(np.average(panel.cell_size)),
     }
-    for nace in df["NACE"].unique():
-        data[f"{nace}_n_patents"] = (
-            df[df["NACE"] == nace].drop_duplicates(subset="Year")["Sum patents"].sum()
-        )
-        data[f"{nace}_n_years"] = (
-            df[(df["NACE"] == nace) & (df["Year"] != 0)]
-            .drop_duplicates(subset="Year")["Year"]
-            .count()
-        )
+    for nace in panel.nace.keys():
+        data[f"{nace}_n_patents"] = panel.nace_sum[nace]
+        data[f"{nace}_n_years"] = panel.nace_years.get(nace, 0)
     return data
 
 
@@ -286,7 +589,7 @@ PLOTLY_TEMPLATE = "plotly_white"
 
 
 def subplots_two_yaxes(
-    df: pd.DataFrame,
+    df: pd.DataFrame | None,
     x: str,
     x_name: str,
     y1: str,
@@ -296,7 +599,12 @@ def subplots_two_yaxes(
     by: str,
     rows: int,
     cols: int,
+    panel: PanelIndex = None,
+    indicator: str = None,
 ):
+    # with a panel index, the rows of indicator are looked up instead of passed as df
+    if panel is not None:
+        df = panel.df if indicator is None else panel.group("Indicator", indicator)
     fig = make_subplots(
         rows=rows,
         cols=cols,
@@ -304,14 +612,14 @@ def subplots_two_yaxes(
         subplot_titles=list(df[by].unique()),
     )
     # add traces
-    for index, value in enumerate(df[by].unique()):
+    for index, (value, group) in enumerate(df.groupby(by, sort=False)):
         row = int(index / 2) + 1
         col = 1 if index % 2 == 0 else 2
         # add trace for left y-axis
         fig.add_trace(
             go.Scatter(
-                x=df[df[by] == value]["Year"],
-                y=df[df[by] == value][y1],
+                x=group["Year"],
+                y=group[y1],
                 mode="lines",
                 line=dict(color="royalblue"),
                 name=y1_name,
@@ -323,8 +631,8 @@ def subplots_two_yaxes(
         # add trace for right y-axis
         fig.add_trace(
             go.Scatter(
-                x=df[df[by] == value][x],
-                y=df[df[by] == value][y2],
+                x=group[x],
+                y=group[y2],
                 mode="lines",
                 line=dict(color="firebrick", dash="dash"),
                 name=y2_name,
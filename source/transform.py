@@ -1,9 +1,59 @@
 # module to transform data returned by extract.py into a dataframe
+import hashlib
+import json
+import numbers
+import os
+
+import numpy as np
 import pandas as pd
-from scipy.signal import detrend
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# Eurostat SBS indicators used in the analysis: long name -> short name
+EUROSTAT_INDICATORS = {
+    "Enterprises - number": "Enterprises (n)",
+    "Persons employed - number": "Employees (n)",
+    "Wage adjusted labour productivity (Apparent labour productivity by average personnel costs) - percentage": "Labor prod. (%)",
+    "Gross value added per employee - thousand euro": "GVA/employee (€)",
+    "Share of personnel costs in production - percentage": "Personnel costs (%)",
+}
+# rescaling of indicators: short name -> (multiplier, divisor)
+EUROSTAT_SCALE = {
+    "GVA/employee (€)": (1000, 1),
+    "Employees (n)": (1, 1000),
+}
+# columns of the SBS csv files that are read, code columns are read as strings
+EUROSTAT_COLUMNS = ["nace_r2", "indic_sb", "geo", "TIME_PERIOD", "OBS_VALUE", "OBS_FLAG"]
+EUROSTAT_CODE_COLUMNS = ["nace_r2", "indic_sb", "geo", "OBS_FLAG"]
+
+
+def read_biblio_parquet(path: str, columns: list = None, filters=None) -> pd.DataFrame:
+    """
+    Read documents written by extract.write_biblio_parquet().
+    Only the requested columns and the partitions matching filters are read.
 
-def tf_search_biblio(ls: list) -> pd.DataFrame:
+    Parameters
+    ----------
+    path : str
+        Root directory of the Parquet dataset
+    columns : list
+        Columns to read, None reads all columns
+    filters : list
+        pyarrow filters, e.g. [("query_industry", "in", ["C", "J"])]
+    """
+    if pq is None:
+        raise ImportError("Reading Parquet requires the 'pyarrow' package.")
+    table = pq.read_table(path, columns=columns, filters=filters, memory_map=True)
+    return table.to_pandas(date_as_object=False)
+
+
+def tf_search_biblio(ls: list | pd.DataFrame) -> pd.DataFrame:
     df = pd.DataFrame(ls)
     # set date columns to datetime
     df["document_date"] = pd.to_datetime(df["document_date"])
@@ -17,53 +67,246 @@ def tf_search_biblio(ls: list) -> pd.DataFrame:
     return df
 
 
+# Function to read rows of an SBS csv file, filters {column: values} are applied while reading
+def read_eurostat_csv(
+    data_path: str, filters: dict = None, chunk_size: int = 500_000
+) -> pd.DataFrame:
+    filters = {column: list(values) for column, values in (filters or {}).items()}
+    if pq is not None:
+        # scan in batches, rows not matching the filters are never converted to pandas
+        file_format = ds.CsvFileFormat(
+            convert_options=pacsv.ConvertOptions(
+                column_types={column: pa.string() for column in EUROSTAT_CODE_COLUMNS},
+                strings_can_be_null=True,
+            )
+        )
+        expression = None
+        for column, values in filters.items():
+            condition = ds.field(column).isin(values)
+            expression = condition if expression is None else expression & condition
+        table = ds.dataset(data_path, format=file_format).to_table(
+            columns=EUROSTAT_COLUMNS, filter=expression
+        )
+        return table.to_pandas()
+    chunks = []
+    for chunk in pd.read_csv(
+        data_path,
+        usecols=EUROSTAT_COLUMNS,
+        dtype={column: str for column in EUROSTAT_CODE_COLUMNS},
+        chunksize=chunk_size,
+    ):
+        mask = np.ones(len(chunk), dtype=bool)
+        for column, values in filters.items():
+            mask &= chunk[column].isin(values).to_numpy()
+        chunks.append(chunk[mask])
+    return pd.concat(chunks, ignore_index=True)[EUROSTAT_COLUMNS]
+
+
 def prep_eurostat_data(
-    data_path: str, indic_sb_codes: str, nace_codes: str
+    data_path: str,
+    indic_sb_codes: str,
+    nace_codes: str,
+    nace: list = None,
+    indicators: list = None,
+    geo: list = None,
+    years: list = None,
+    categorical: bool = False,
+    cache_dir: str = None,
 ) -> pd.DataFrame:
-    rename = {
-        "Enterprises - number": "Enterprises (n)",
-        "Persons employed - number": "Employees (n)",
-        "Wage adjusted labour productivity (Apparent labour productivity by average personnel costs) - percentage": "Labor prod. (%)",
-        "Gross value added per employee - thousand euro": "GVA/employee (€)",
-        "Share of personnel costs in production - percentage": "Personnel costs (%)",
-    }
+    """
+    Read Eurostat SBS data, name indicators and industries and rescale values.
+    Filters are pushed down into the csv scan, so large extracts (all NACE levels,
+    countries and years) are never loaded completely.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to the SBS csv file
+    indic_sb_codes : str
+        Path to the tsv file of indicator codes and names
+    nace_codes : str
+        Path to the tsv file of NACE codes and names
+    nace : list
+        NACE codes to keep, None keeps all
+    indicators : list
+        Short names of the indicators to keep (see EUROSTAT_INDICATORS), None keeps all of them
+    geo : list
+        Geo codes to keep, e.g. ['EU27_2020'], None keeps all
+    years : list
+        Years to keep, None keeps all
+    categorical : bool
+        Return the code and name columns as categoricals instead of strings
+    cache_dir : str
+        Directory of a Parquet cache of the prepared data, None disables the cache
+    """
+    if cache_dir is not None:
+        # files are identified by path, size and modification time, filters by value
+        stats = [os.stat(path) for path in [data_path, indic_sb_codes, nace_codes]]
+        key = json.dumps(
+            [
+                [data_path, indic_sb_codes, nace_codes],
+                [[stat.st_size, stat.st_mtime_ns] for stat in stats],
+                [nace, indicators, geo, years and [int(year) for year in years]],
+                categorical,
+            ],
+            default=list,
+        )
+        cache_path = os.path.join(
+            cache_dir, f"eurostat-{hashlib.sha1(key.encode()).hexdigest()[:16]}.parquet"
+        )
+        if os.path.exists(cache_path):
+            return pd.read_parquet(cache_path)
+    # mapping tables: indicator code -> short name, NACE code -> industry
     indic_sb_codes = pd.read_csv(
         indic_sb_codes, sep="\t", header=None, names=["indic_sb", "indic_sb_name"]
     )
+    indic_sb_codes["indic_sb_name"] = indic_sb_codes["indic_sb_name"].map(
+        EUROSTAT_INDICATORS
+    )
+    indic_sb_codes = indic_sb_codes.dropna().drop_duplicates(subset="indic_sb")
+    if indicators is not None:
+        indic_sb_codes = indic_sb_codes[indic_sb_codes["indic_sb_name"].isin(indicators)]
+    indicator_names = indic_sb_codes.set_index("indic_sb")["indic_sb_name"]
     nace_codes = pd.read_csv(
         nace_codes, sep="\t", header=None, names=["nace_r2", "Industry"]
     )
-    sbs_stats = pd.read_csv(data_path)
-    df = sbs_stats.merge(indic_sb_codes, on="indic_sb", how="left")
-    df = df.merge(nace_codes, on="nace_r2", how="left")
-    df.drop(columns=["STRUCTURE", "STRUCTURE_ID", "freq"], inplace=True)
-    df["indic_sb_name"] = df["indic_sb_name"].apply(lambda x: rename[x])
-    # scale gross value added per employee
-    df.loc[df["indic_sb_name"] == "GVA/employee (€)", "OBS_VALUE"] = df.loc[df["indic_sb_name"] == "GVA/employee (€)", "OBS_VALUE"] * 1000
-    df.loc[df["indic_sb_name"] == "Employees (n)", "OBS_VALUE"] = df.loc[df["indic_sb_name"] == "Employees (n)", "OBS_VALUE"] / 1000
+    industries = nace_codes.drop_duplicates(subset="nace_r2").set_index("nace_r2")[
+        "Industry"
+    ]
+    filters = {"indic_sb": indicator_names.index}
+    if nace is not None:
+        filters["nace_r2"] = nace
+    if geo is not None:
+        filters["geo"] = geo
+    if years is not None:
+        filters["TIME_PERIOD"] = [int(year) for year in years]
+    df = read_eurostat_csv(data_path, filters)
+    # names and scales are looked up once per category instead of once per row
+    for column in ["nace_r2", "indic_sb", "geo"]:
+        df[column] = df[column].astype("category")
+    df["indic_sb_name"] = df["indic_sb"].map(indicator_names)
+    df["Industry"] = df["nace_r2"].map(industries)
+    multiplier = df["indic_sb_name"].map(
+        {name: scale[0] for name, scale in EUROSTAT_SCALE.items()}
+    )
+    divisor = df["indic_sb_name"].map(
+        {name: scale[1] for name, scale in EUROSTAT_SCALE.items()}
+    )
+    scaled = (
+        df["OBS_VALUE"].to_numpy()
+        * multiplier.astype(float).fillna(1).to_numpy()
+        / divisor.astype(float).fillna(1).to_numpy()
+    )
+    df["OBS_VALUE"] = scaled
+    if not categorical:
+        for column in ["nace_r2", "indic_sb", "geo", "indic_sb_name", "Industry"]:
+            df[column] = df[column].astype(df[column].cat.categories.dtype)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        df.to_parquet(cache_path + ".tmp")
+        os.replace(cache_path + ".tmp", cache_path)
     return df
 
 
-def prep_patents(patents_df) -> pd.DataFrame:
+def detrend_groups(
+    df: pd.DataFrame, by: list, cols: list, detrend_type: str | int = "linear"
+) -> pd.DataFrame:
+    """
+    Remove a least-squares polynomial trend from cols within each group, in one pass over all groups.
+    The trend is fitted over the position within the group (rows must be sorted by time),
+    which gives the same results as scipy.signal.detrend applied to each group.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame sorted by time within each group
+    by : list
+        Columns identifying the groups
+    cols : list
+        Columns to detrend
+    detrend_type : str | int
+        'constant' (subtract mean), 'linear' or the degree of a polynomial trend
+    """
+    degree = {"constant": 0, "linear": 1}.get(detrend_type, detrend_type)
+    if not isinstance(degree, numbers.Integral) or isinstance(degree, bool) or degree < 0:
+        raise ValueError(
+            "Argument detrend_type either constant, linear or a polynomial degree"
+        )
+    degree = int(degree)
+    group = df.groupby(by, sort=False).ngroup().to_numpy()
+    n_groups = group.max() + 1 if len(group) > 0 else 0
+    # position within group, centered and scaled to keep the normal equations well conditioned
+    t = df.groupby(by, sort=False).cumcount().to_numpy(dtype=float)
+    size = np.bincount(group, minlength=n_groups).astype(float)
+    t = (t - ((size - 1) / 2)[group]) / np.maximum(size - 1, 1)[group]
+    vander = np.vander(t, degree + 1, increasing=True)  # (rows, degree + 1)
+    # per-group normal equations X'X and X'y, summed with one bincount per entry
+    xtx = np.empty((n_groups, degree + 1, degree + 1))
+    for i in range(degree + 1):
+        for j in range(degree + 1):
+            xtx[:, i, j] = np.bincount(
+                group, weights=vander[:, i] * vander[:, j], minlength=n_groups
+            )
+    xtx_inv = np.linalg.pinv(xtx)
+    detrended = df[cols].copy()
+    for col in cols:
+        y = df[col].to_numpy(dtype=float)
+        xty = np.stack(
+            [
+                np.bincount(group, weights=vander[:, i] * y, minlength=n_groups)
+                for i in range(degree + 1)
+            ],
+            axis=1,
+        )
+        coef = np.einsum("gij,gj->gi", xtx_inv, xty)
+        detrended[col] = y - np.einsum("ri,ri->r", vander, coef[group])
+    return detrended
+
+
+def prep_patents(
+    patents_df,
+    weight_col: str = None,
+    extra_regressors: pd.DataFrame = None,
+    by_country: bool = False,
+) -> pd.DataFrame:
+    # weight_col: column holding a weight per patent, e.g. citation_weight
+    # added by citations.add_citation_weights(); patents are counted if None
+    # extra_regressors: counts by query_industry and document_date_year,
+    # e.g. from cpc.field_counts(); carried through prep_data() as extra columns
+    # by_country: count patents by query_country, industry and year (country panel)
+    entity = ["query_country", "query_industry"] if by_country else ["query_industry"]
     # drop duplicates in each indsurty
-    patents_df.drop_duplicates(subset=["query_industry", "document_id"], inplace=True)
+    patents_df.drop_duplicates(subset=entity + ["document_id"], inplace=True)
     # keep only patents extracted for years in which eurostat data is available (2011-2020)
     patents_df = patents_df[
         (patents_df["document_date_year"] >= 2011)
         & (patents_df["document_date_year"] <= 2020)
     ]
     # get number of patents by industry and year
-    patents_gr_industry_year = (
-        patents_df.groupby(["query_industry", "document_date_year"])
-        .size()
-        .reset_index(name="sum_patents")
-    )
+    grouped = patents_df.groupby(entity + ["document_date_year"])
+    if weight_col is None:
+        patents_gr_industry_year = grouped.size().reset_index(name="sum_patents")
+    else:
+        patents_gr_industry_year = (
+            grouped[weight_col].sum().reset_index(name="sum_patents")
+        )
     # sort patents
     patents_gr_industry_year.sort_values(by="sum_patents", ascending=False)
     # keep only patents that have at least four years of data
-    prepped_patents = patents_gr_industry_year.groupby(by=["query_industry"]).filter(
-        lambda x: len(x) >= 4
+    n_years = patents_gr_industry_year.groupby(entity)["document_date_year"].transform(
+        "size"
     )
+    prepped_patents = patents_gr_industry_year[n_years >= 4]
+    if extra_regressors is not None:
+        prepped_patents = prepped_patents.merge(
+            extra_regressors,
+            on=[
+                column
+                for column in entity + ["document_date_year"]
+                if column in extra_regressors.columns
+            ],
+            how="left",
+        ).fillna(0)
     return prepped_patents
 
 
@@ -71,19 +314,25 @@ def prep_data(
     prepped_patents_df: pd.DataFrame,
     prepped_eurostat_df: pd.DataFrame,
     time_all: bool = False,
-    detrended: bool = False
+    detrended: bool = False,
+    detrend_type: str | int = "linear",
+    by_country: bool = False,
 ) -> pd.DataFrame:
+    # by_country: country x industry x year panel, patents from prep_patents(by_country=True)
+    # are joined to the Eurostat data of the same country (geo)
+    entity = ["geo", "nace_r2"] if by_country else ["nace_r2"]
     # merge eurostat data with patent data
     df = pd.merge(
         prepped_eurostat_df,
         prepped_patents_df,
         how="left",
-        left_on=["nace_r2", "TIME_PERIOD"],
-        right_on=["query_industry", "document_date_year"],
+        left_on=entity + ["TIME_PERIOD"],
+        right_on=(["query_country"] if by_country else [])
+        + ["query_industry", "document_date_year"],
     )
     # sort dataframe
     df.sort_values(
-        by=["nace_r2", "indic_sb", "TIME_PERIOD"], inplace=True, ascending=True
+        by=entity + ["indic_sb", "TIME_PERIOD"], inplace=True, ascending=True
     )
     # account for NaN values within each industry and indicator
     # e.g., patents for an industry were only retrieved for the years [2016, 2018, 2019, 2020]
@@ -94,21 +343,29 @@ def prep_data(
     df["document_date_year"] = df["TIME_PERIOD"]
     # fill indsutry column
     df["query_industry"] = df["nace_r2"]
-    # assign 0 patent retrievals to NaN values
-    df["sum_patents"] = df["sum_patents"].fillna(0)
+    if by_country:
+        df["query_country"] = df["geo"]
+    # assign 0 patent retrievals to NaN values, also for extra regressors of prep_patents()
+    extra_cols = [
+        column
+        for column in prepped_patents_df.columns
+        if column
+        not in ["query_country", "query_industry", "document_date_year", "sum_patents"]
+    ]
+    df[["sum_patents"] + extra_cols] = df[["sum_patents"] + extra_cols].fillna(0)
     # get cumulative sum of patents per industry and indicator
-    df["cumsum_patents"] = df.groupby(["nace_r2", "indic_sb"])["sum_patents"].cumsum()
+    df["cumsum_patents"] = df.groupby(entity + ["indic_sb"])["sum_patents"].cumsum()
     # Calculate the min and max year for each industry
     years_min_max = (
         df[df["sum_patents"] != 0]
-        .groupby("nace_r2")
+        .groupby(entity)
         .agg(
             min_year=("document_date_year", "min"),
             max_year=("document_date_year", "max"),
         )
     )
     # Merge the minimum year back to the original dataframe
-    prepped_df = df.merge(years_min_max, on="nace_r2")
+    prepped_df = df.merge(years_min_max, on=entity)
     if time_all is False:
         # Keep only values in min_max time span for each industry
         prepped_df = prepped_df[
@@ -118,24 +375,22 @@ def prep_data(
     # Drop N/As in OBS_VALUE column
     # Cannot have N/A for regression. Replacing with 0 would be misleading
     prepped_df = prepped_df.dropna(subset="OBS_VALUE")
-    # detrend "OBS_VALUE" and "sum patents"
+    # detrend "OBS_VALUE" and "sum patents" within each industry and indicator
     if detrended is True:
-        for industry in prepped_df["nace_r2"].unique():
-            for indicator in prepped_df["indic_sb_name"].unique():
-                # There probably is a nicer way to do this. But it works.
-                # create copy of df
-                tmp_df = prepped_df.loc[(prepped_df["nace_r2"] == industry) & (prepped_df["indic_sb_name"] == indicator)]
-                # loc group and replace values with detrended series
-                prepped_df.loc[(prepped_df["nace_r2"] == industry)
-                               & (prepped_df["indic_sb_name"] == indicator), "OBS_VALUE"] = detrend(tmp_df["OBS_VALUE"])
-                prepped_df.loc[(prepped_df["nace_r2"] == industry)
-                               & (prepped_df["indic_sb_name"] == indicator), "sum_patents"] = detrend(tmp_df["sum_patents"])
+        cols = ["OBS_VALUE", "sum_patents"] + extra_cols
+        prepped_df[cols] = detrend_groups(
+            prepped_df,
+            by=entity + ["indic_sb_name"],
+            cols=cols,
+            detrend_type=detrend_type,
+        )
     prepped_df.rename(
         columns={
             "sum_patents": "Sum patents",
             "document_date_year": "Year",
             "nace_r2": "NACE",
             "indic_sb_name": "Indicator",
+            **({"geo": "Country"} if by_country else {}),
         },
         inplace=True,
     )
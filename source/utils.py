@@ -1,12 +1,33 @@
+import gc
+import gzip
+import io
 import json
+import logging
+import os
 import re
+import threading
+from contextlib import contextmanager
 from json import JSONDecodeError
 import yaml
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
 
 def write_to_file(path, ls) -> None:
     """
     Write retrieved data to file.
+    The whole file is read and rewritten on every call, use JsonlWriter for large harvests.
     Parameters
     ----------
     retrieved_data_path : str
@@ -31,6 +52,173 @@ def write_to_file(path, ls) -> None:
         pass
 
 
+# parse JSON with orjson if it is installed
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# serialize JSON with orjson if it is installed, returns bytes
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+# pause the cyclic garbage collector while many small objects are created at once
+# (e.g. parsing a harvest), which otherwise triggers repeated full collections
+@contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# infer compression from the file extension
+def get_compression(path, compression="infer"):
+    if compression != "infer":
+        return compression
+    if str(path).endswith(".gz"):
+        return "gzip"
+    if str(path).endswith(".zst"):
+        return "zstd"
+    return None
+
+
+def _check_zstandard():
+    if zstandard is None:
+        raise ImportError("zstd compression requires the 'zstandard' package.")
+
+
+class JsonlWriter:
+    def __init__(self, path, compression="infer", batch_size=100, fsync_every=1000):
+        """
+        Append-only writer storing one JSON record per line.
+        Records are buffered and written in batches; every fsync_every records the
+        file is flushed to disk, so a crash loses at most the records since the last checkpoint.
+
+        Parameters
+        ----------
+        path : str
+            Path to the JSONL file; '.gz' and '.zst' files are compressed
+        compression : str
+            'infer', None, 'gzip' or 'zstd'
+        batch_size : int
+            Number of records buffered before they are written
+        fsync_every : int
+            Number of records after which the file is synced to disk
+        """
+        self.path = path
+        self.compression = get_compression(path, compression)
+        self.batch_size = batch_size
+        self.fsync_every = fsync_every
+        self.buffer = []
+        self.unsynced = 0
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        if self.compression == "gzip":
+            # appending creates a new gzip member, which is read as one stream
+            self.stream = gzip.GzipFile(fileobj=self.file, mode="ab")
+        elif self.compression == "zstd":
+            _check_zstandard()
+            self.stream = zstandard.ZstdCompressor().stream_writer(
+                self.file, closefd=False
+            )
+        elif self.compression is None:
+            self.stream = self.file
+        else:
+            raise ValueError("Argument compression either None, gzip or zstd")
+
+    def write(self, record) -> None:
+        if record is None:
+            return
+        line = dumps(record) + b"\n"
+        with self.lock:
+            self.buffer.append(line)
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_every:
+                self._flush(fsync=True)
+            elif len(self.buffer) >= self.batch_size:
+                self._flush(fsync=False)
+
+    def _flush(self, fsync):
+        self.stream.write(b"".join(self.buffer))
+        self.buffer = []
+        if fsync:
+            # end the compressed block so everything written so far can be decompressed
+            if self.compression == "zstd":
+                self.stream.flush(zstandard.FLUSH_FRAME)
+            elif self.compression == "gzip":
+                self.stream.flush()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def flush(self, fsync=True) -> None:
+        with self.lock:
+            self._flush(fsync=fsync)
+
+    def close(self) -> None:
+        with self.lock:
+            self._flush(fsync=True)
+            if self.stream is not self.file:
+                self.stream.close()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_lines(path, compression="infer"):
+    """
+    Generator yielding the non-empty raw lines (bytes) of a possibly compressed file.
+    """
+    compression = get_compression(path, compression)
+    if compression == "gzip":
+        f = gzip.open(path, "rb")
+    elif compression == "zstd":
+        _check_zstandard()
+        f = io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(
+                open(path, "rb"), read_across_frames=True, closefd=True
+            )
+        )
+    else:
+        f = open(path, "rb")
+    with f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield line
+        except EOFError:
+            logger.warning(f"{path} ends with an incomplete compressed block")
+
+
+# Function to parse JSONL lines, an incomplete line (e.g. after a crash) is skipped
+def parse_lines(lines):
+    for line in lines:
+        try:
+            yield loads(line)
+        except ValueError:
+            logger.warning(f"Skipping incomplete record: {line[:80]}")
+
+
+def read_jsonl(path, compression="infer"):
+    """
+    Generator yielding the records of a JSONL file written by JsonlWriter.
+    An incomplete last line (e.g. after a crash) is skipped.
+    """
+    return parse_lines(read_lines(path, compression))
+
+
 # Function to count the number of words between quotation marks
 # This is used to count the number of words in the query
 # This is necessary because the OPS API has a limit of 20 words (terms) per query
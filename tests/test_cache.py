@@ -0,0 +1,100 @@
+import os
+from time import time
+
+import pytest
+import requests
+
+from source.api import ENDPOINTS, OPSClient
+from source.cache import CacheMissError, ResponseCache
+
+URL = ENDPOINTS["biblio-search"]
+PARAMS = {"Range": "1-100", "q": "ta=ai"}
+
+
+def response(content='{"results": []}', status_code=200):
+    r = requests.Response()
+    r.status_code = status_code
+    r.headers["Content-Type"] = "application/json"
+    r.url = URL
+    r._content = content.encode("utf-8")
+    return r
+
+
+def age(cache, key, seconds):
+    # move the modification time of an entry into the past
+    path = cache._path(key)
+    modified = time() - seconds
+    os.utime(path, (modified, modified))
+
+
+def test_roundtrip(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    key = cache.key("GET", URL, PARAMS)
+    assert cache.get(key) is None
+    cache.set(key, response())
+    cached = cache.get(key)
+    assert cached.status_code == 200
+    assert cached.json() == {"results": []}
+    assert cached.headers["content-type"] == "application/json"
+
+
+def test_key_depends_on_request():
+    key = ResponseCache.key("GET", URL, PARAMS)
+    assert key == ResponseCache.key("get", URL, dict(reversed(PARAMS.items())))
+    assert key != ResponseCache.key("GET", URL, {**PARAMS, "Range": "101-200"})
+    assert key != ResponseCache.key("POST", URL, PARAMS, data="EP.1.A1")
+
+
+def test_expired_entries_are_missing(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=60)
+    key = cache.key("GET", URL, PARAMS)
+    cache.set(key, response())
+    assert cache.get(key) is not None
+    age(cache, key, 120)
+    assert cache.get(key) is None
+
+
+def test_offline_serves_expired_entries(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=60, offline=True)
+    key = cache.key("GET", URL, PARAMS)
+    cache.set(key, response())
+    age(cache, key, 120)
+    assert cache.get(key).status_code == 200
+
+
+def test_offline_client(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=60, offline=True)
+    client = OPSClient(None, None, Cache=cache)
+    with pytest.raises(CacheMissError):
+        client.request("GET", URL, params=PARAMS)
+    key = cache.key("GET", URL, PARAMS)
+    cache.set(key, response())
+    age(cache, key, 120)
+    assert client.request("GET", URL, params=PARAMS).json() == {"results": []}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    keys = [cache.key("GET", URL, {"q": str(i)}) for i in range(5)]
+    for i, key in enumerate(keys):
+        # random content does not compress, so entries have about the same size
+        cache.set(key, response(os.urandom(500).hex()))
+        age(cache, key, 100 - i)
+    cache.max_bytes = int(cache.size * 0.7)
+    cache.get(keys[0])
+    cache.set(cache.key("GET", URL, {"q": "new"}), response(os.urandom(500).hex()))
+    assert cache.size <= cache.max_bytes
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.size == sum(os.path.getsize(path) for path in cache._files())
+
+
+def test_recency_survives_restart(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    keys = [cache.key("GET", URL, {"q": str(i)}) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.set(key, response(os.urandom(500).hex()))
+        age(cache, key, 100 - i)
+    cache.get(keys[0])
+    reopened = ResponseCache(str(tmp_path))
+    assert list(reopened.entries) == [cache._path(k) for k in keys[1:] + keys[:1]]
@@ -0,0 +1,117 @@
+import itertools
+import re
+
+import pytest
+
+from source.construct_query import (
+    MAX_IDENTIFIER_TERMS,
+    MAX_TERMS,
+    count_identifier_terms,
+    get_keywords,
+    is_valid_query,
+    pack_keywords,
+    plan_queries,
+    return_all_queries,
+)
+from source.utils import count_words_between_quotes
+
+ACTIVITIES = [
+    ("C", "10", "Manufacture of food products, meat processing and preserving"),
+    ("C", "10", "Processing and preserving of fish, crustaceans and molluscs"),
+    ("C", "11", "Manufacture of beverages, distilling rectifying and blending of spirits"),
+    ("C", "26", "Manufacture of computer, electronic and optical products"),
+    ("K", "64", "Financial service activities, except insurance and pension funding"),
+]
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "nace_codes.csv"
+    lines = ["Section,Division,Activity"] + [
+        f'{section},{division},"{activity}"' for section, division, activity in ACTIVITIES
+    ]
+    path.write_text("\n".join(lines))
+    return {
+        "paths": {"nace_codes_csv": str(path)},
+        "NACE_INDSUTRIES_LV_1": {"C": ["manufacturing"], "K": ["finance", "insurance"]},
+        "CPC": {"ai": ["G06N", "G06F18", "G06V"]},
+        "EU_COUNTRY_CODES": {"AT": "Austria", "BE": "Belgium", "DE": "Germany"},
+    }
+
+
+def keywords(query):
+    # words of the packed 'ta =' keywords of a planned query
+    return re.findall(r'ta = "(.*?)"', query)
+
+
+def test_is_valid_query_term_limit():
+    words = " ".join(f"w{i}" for i in range(MAX_TERMS))
+    assert is_valid_query(f'ta = "{words}"')
+    assert not is_valid_query(f'ta = "{words} one_more"')
+
+
+def test_is_valid_query_identifier_limit():
+    terms = [f'ta = "w{i}"' for i in range(MAX_IDENTIFIER_TERMS)]
+    assert is_valid_query(" OR ".join(terms))
+    assert not is_valid_query(" OR ".join(terms + ['ta = "w"']))
+    # cpc symbols count as terms of the query, but not against the identifier limit
+    cpc = 'cpc any "' + " ".join(f"G0{i}" for i in range(MAX_IDENTIFIER_TERMS + 1)) + '"'
+    assert is_valid_query(cpc)
+
+
+def test_count_identifier_terms():
+    query = '(ta ALL "a b" OR ta ALL "c") AND (ta = "d") AND cpc any "G06N G06V" AND AP="DE"'
+    assert count_identifier_terms(query) == {"ta": 3, "cpc": 2, "AP": 1}
+
+
+def test_pack_keywords_respects_limits():
+    words = [f"w{i}" for i in range(7)] + ["two words", "three word phrase"]
+    strings = pack_keywords(words, max_words=5, max_keywords=3)
+    packed = [keywords(s) for s in strings]
+    assert sorted(itertools.chain.from_iterable(packed)) == sorted(words)
+    for keyword_list in packed:
+        assert len(keyword_list) <= 3
+        assert sum(len(k.split()) for k in keyword_list) <= 5
+    # first fit decreasing needs the minimum number of strings here
+    assert len(strings) == 4
+
+
+def test_pack_keywords_rejects_oversized_keyword():
+    with pytest.raises(ValueError):
+        pack_keywords(["a b c"], max_words=2, max_keywords=3)
+
+
+@pytest.mark.parametrize("merge_divisions", [False, True])
+@pytest.mark.parametrize("merge_countries", [False, True])
+def test_plan_queries_within_limits(config, merge_divisions, merge_countries):
+    plan = plan_queries(
+        config, merge_divisions=merge_divisions, merge_countries=merge_countries
+    )
+    for query in return_all_queries(plan):
+        assert count_words_between_quotes(query) <= MAX_TERMS
+        assert count_identifier_terms(query)["ta"] <= MAX_IDENTIFIER_TERMS
+    # every country is covered once per industry
+    for industry in ["C", "K"]:
+        countries = [c for key in plan if industry in plan[key] for c in key.split("|")]
+        assert sorted(countries) == ["AT", "BE", "DE"]
+
+
+def test_plan_queries_covers_all_keywords(config):
+    division_keywords = get_keywords(config)[0]
+    plan = plan_queries(config, max_terms=12, max_identifier_terms=5)
+    for division, queries in plan["DE"]["C"].items():
+        for query in queries:
+            assert is_valid_query(query, max_terms=12, max_identifier_terms=5)
+        packed = list(itertools.chain.from_iterable(keywords(q) for q in queries))
+        assert sorted(packed) == sorted(division_keywords[division])
+
+
+def test_merging_reduces_queries(config):
+    n_queries = len(return_all_queries(plan_queries(config)))
+    merged = plan_queries(config, merge_divisions=True, merge_countries=True)
+    assert len(return_all_queries(merged)) < n_queries
+
+
+def test_plan_queries_raises_if_nothing_fits(config):
+    with pytest.raises(ValueError):
+        plan_queries(config, max_terms=5)
@@ -0,0 +1,103 @@
+from source.dedup import BloomFilter, DocumentIndex
+from source.extract import iter_published_biblio
+from source.harvest import Job
+
+JOB = Job("DE", "C", "10.0", "q1", 1, 100)
+OTHER_JOB = Job("AT", "C", "10.0", "q2", 1, 100)
+
+
+def rows(*documents):
+    return [
+        {"publication_number": publication_number, "family_id": family_id}
+        for publication_number, family_id in documents
+    ]
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=1000)
+    items = [f"EP{i}A1" for i in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    false_positives = sum(f"US{i}B2" in bloom for i in range(10000))
+    assert false_positives < 100
+
+
+def test_publications_are_returned_once(tmp_path):
+    index = DocumentIndex(str(tmp_path / "documents.sqlite"))
+    assert index.add_search_results(JOB, rows(("EP1A1", "1"), ("EP1B1", "1"))) == [
+        "EP1A1",
+        "EP1B1",
+    ]
+    assert index.add_search_results(OTHER_JOB, rows(("EP1A1", "1"), ("EP2A1", "2"))) == [
+        "EP2A1"
+    ]
+    assert index.memberships(["EP1A1"]) == {
+        "EP1A1": [("AT", "C", "10.0"), ("DE", "C", "10.0")]
+    }
+
+
+def test_families_are_fetched_once(tmp_path):
+    path = str(tmp_path / "documents.sqlite")
+    index = DocumentIndex(path, families=True)
+    assert index.add_search_results(JOB, rows(("EP1A1", "1"), ("EP1B1", "1"))) == [
+        "EP1A1"
+    ]
+    index.close()
+    # known families survive a restart
+    index = DocumentIndex(path, families=True)
+    assert index.add_search_results(OTHER_JOB, rows(("US1A1", "1"), ("EP2A1", "2"))) == [
+        "EP2A1"
+    ]
+    assert sorted(index.unfetched()) == ["EP1A1", "EP2A1"]
+    # memberships are recorded for every publication returned by a query
+    assert set(index.memberships()) == {"EP1A1", "EP1B1", "US1A1", "EP2A1"}
+
+
+def test_fetched_documents(tmp_path):
+    index = DocumentIndex(str(tmp_path / "documents.sqlite"))
+    index.add_search_results(JOB, rows(("EP1A1", "1"), ("EP2A1", "2")))
+    index.mark_fetched(["EP1A1"])
+    assert index.unfetched() == ["EP2A1"]
+    assert "EP1A1" in index and "EP3A1" not in index
+
+
+def test_family_memberships_reach_published_rows(tmp_path):
+    index = DocumentIndex(str(tmp_path / "documents.sqlite"), families=True)
+    c_job = Job("DE", "C", "26.0", "q1", 1, 100)
+    j_job = Job("DE", "J", "62.0", "q2", 1, 100)
+    assert index.add_search_results(c_job, rows(("EP3000001A1", "7"))) == ["EP3000001A1"]
+    assert index.add_search_results(j_job, rows(("EP3000001B1", "7"))) == []
+    memberships = index.memberships(index.unfetched())
+    assert memberships == {"EP3000001A1": [("DE", "C", "26.0"), ("DE", "J", "62.0")]}
+    # only the representative is fetched, its rows carry both industries
+    record = {
+        "response": {
+            "ops:world-patent-data": {
+                "exchange-documents": {
+                    "exchange-document": [
+                        {
+                            "@system": "ops.epo.org",
+                            "@family-id": "7",
+                            "@country": "EP",
+                            "@doc-number": "3000001",
+                            "@kind": "A1",
+                        }
+                    ]
+                }
+            }
+        }
+    }
+    published = list(iter_published_biblio([record], memberships))
+    assert [row["query_industry"] for row in published] == ["C", "J"]
+    assert {row["document_family_id"] for row in published} == {"7"}
+
+
+def test_memberships_without_families_stay_per_publication(tmp_path):
+    index = DocumentIndex(str(tmp_path / "documents.sqlite"))
+    index.add_search_results(JOB, rows(("EP1A1", "1")))
+    index.add_search_results(OTHER_JOB, rows(("EP1B1", "1")))
+    assert index.memberships() == {
+        "EP1A1": [("DE", "C", "10.0")],
+        "EP1B1": [("AT", "C", "10.0")],
+    }
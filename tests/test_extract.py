@@ -0,0 +1,258 @@
+import json
+
+from source.extract import extract_biblio, iter_published_biblio, load_biblio_json
+
+
+def v(x):
+    return {"$": x}
+
+
+def classification(main_group):
+    return {
+        "classification-scheme": {"@office": "EP", "@scheme": "CPCI"},
+        "section": v("G"),
+        "class": v("06"),
+        "subclass": v("N"),
+        "main-group": v(main_group),
+        "subgroup": v("08"),
+        "classification-value": v("I"),
+        "generating-office": v("EP"),
+    }
+
+
+def party(kind, name, data_format):
+    return {"@data-format": data_format, f"{kind}-name": {"name": v(name)}}
+
+
+# complete document, lists everywhere
+FULL = {
+    "exchange-document": {
+        "@system": "ops.epo.org",
+        "@family-id": "1",
+        "@country": "EP",
+        "@doc-number": "3000001",
+        "@kind": "A1",
+        "bibliographic-data": {
+            "publication-reference": {
+                "document-id": [
+                    {"@document-id-type": "docdb", "date": v("20190301")},
+                    {"@document-id-type": "epodoc", "date": v("20190302")},
+                ]
+            },
+            "patent-classifications": {
+                "patent-classification": [classification("3"), classification("20")]
+            },
+            "application-reference": {"@doc-id": "1", "document-id": [v("a")]},
+            "priority-claims": {"priority-claim": [v("b")]},
+            "parties": {
+                "applicants": {
+                    "applicant": [
+                        party("applicant", "ACME GMBH [DE]", "epodoc"),
+                        party("applicant", "Acme GmbH", "original"),
+                    ]
+                },
+                "inventors": {
+                    "inventor": [
+                        party("inventor", "DOE JANE", "epodoc"),
+                        party("inventor", "Doe, Jane", "original"),
+                    ]
+                },
+            },
+            "invention-title": [
+                {"@lang": "en", "$": "Title"},
+                {"@lang": "fr", "$": "Titre"},
+                {"@lang": "de", "$": "Titel"},
+            ],
+            "references-cited": {
+                "citation": [
+                    {
+                        "patcit": {
+                            "document-id": [
+                                {
+                                    "@document-id-type": "epodoc",
+                                    "doc-number": v("US2010001"),
+                                    "name": v("SMITH"),
+                                    "date": v("20100101"),
+                                },
+                                {"@document-id-type": "docdb", "doc-number": v("x")},
+                            ]
+                        }
+                    },
+                    {"nplcit": {"text": v("Some paper")}},
+                    {
+                        "patcit": {
+                            "document-id": [
+                                {"@document-id-type": "epodoc", "doc-number": v("WO2011")}
+                            ]
+                        }
+                    },
+                ]
+            },
+        },
+        "abstract": {"@lang": "en", "p": v("Abstract text")},
+    }
+}
+
+# single classification and citation as dicts, no inventors and no abstract
+SPARSE = {
+    "exchange-document": {
+        "@system": "ops.epo.org",
+        "@family-id": "2",
+        "@country": "EP",
+        "@doc-number": "3000002",
+        "@kind": "B1",
+        "bibliographic-data": {
+            "publication-reference": {
+                "document-id": [{"@document-id-type": "docdb", "date": v("20200101")}]
+            },
+            "patent-classifications": {"patent-classification": classification("5")},
+            "application-reference": {"@doc-id": "2"},
+            "priority-claims": {"priority-claim": v("c")},
+            "parties": {
+                "applicants": {
+                    "applicant": [party("applicant", "Example Corp", "original")]
+                }
+            },
+            "invention-title": [{"@lang": "de", "$": "Titel"}],
+            "references-cited": {
+                "citation": {
+                    "patcit": {
+                        "document-id": [
+                            {
+                                "@document-id-type": "epodoc",
+                                "doc-number": v("EP1"),
+                                "date": v("19990101"),
+                            }
+                        ]
+                    }
+                }
+            },
+        },
+    }
+}
+
+# rows the original nested-loop parser returned for FULL and SPARSE
+EXPECTED = [
+    {
+        "query_country": "DE",
+        "query_industry": "C",
+        "query_division": "10.0",
+        "document_system": "ops.epo.org",
+        "document_family_id": "1",
+        "document_country": "EP",
+        "document_doc-number": "3000001",
+        "document_kind": "A1",
+        "document_date": "20190301",
+        "patent_classifications": [
+            {"EP": ["G", "06", "N", "3", "08", "I", "EP"]},
+            {"EP": ["G", "06", "N", "20", "08", "I", "EP"]},
+        ],
+        "application-reference": {"@doc-id": "1", "document-id": [v("a")]},
+        "priority-claims": {"priority-claim": [v("b")]},
+        "applicants": ["Acme GmbH"],
+        "inventors": ["Doe, Jane"],
+        "invention-title": [{"en": "Title"}, {"de": "Titel"}],
+        "references_cited": [
+            ("US2010001", "SMITH", "20100101"),
+            ("WO2011", "", ""),
+        ],
+        "abstract": "Abstract text",
+    },
+    {
+        "query_country": "DE",
+        "query_industry": "C",
+        "query_division": "10.0",
+        "document_system": "ops.epo.org",
+        "document_family_id": "2",
+        "document_country": "EP",
+        "document_doc-number": "3000002",
+        "document_kind": "B1",
+        "document_date": "20200101",
+        "patent_classifications": [{"EP": ["G", "06", "N", "5", "08", "I", "EP"]}],
+        "application-reference": {"@doc-id": "2"},
+        "priority-claims": {"priority-claim": v("c")},
+        "applicants": ["Example Corp"],
+        "inventors": None,
+        "invention-title": [{"de": "Titel"}],
+        "references_cited": [("EP1", "", "19990101")],
+        "abstract": None,
+    },
+]
+
+
+def record(documents, response=True):
+    return {
+        "country": "DE",
+        "industry": "C",
+        "division": "10.0",
+        "query": "q",
+        "response": {
+            "ops:world-patent-data": {
+                "ops:biblio-search": {
+                    "@total-result-count": "2",
+                    "ops:search-result": {"exchange-documents": documents},
+                }
+            }
+        }
+        if response
+        else None,
+    }
+
+
+def test_extract_biblio_matches_original_parser():
+    assert extract_biblio([record([FULL, SPARSE])]) == EXPECTED
+
+
+def test_single_document_response():
+    assert extract_biblio([record(SPARSE)]) == EXPECTED[1:]
+
+
+def test_failed_requests_are_skipped():
+    assert extract_biblio([record(None, response=False), record(FULL)]) == EXPECTED[:1]
+
+
+def test_missing_publication_date():
+    document = json.loads(json.dumps(SPARSE))
+    del document["exchange-document"]["bibliographic-data"]["publication-reference"]
+    (row,) = extract_biblio([record(document)])
+    assert row["document_date"] is None
+
+
+def test_load_biblio_json(tmp_path):
+    path = tmp_path / "biblio.json"
+    path.write_text(json.dumps([record([FULL, SPARSE])]))
+    assert load_biblio_json(str(path)) == EXPECTED
+
+
+def published(documents):
+    # published-data biblio response: several documents under one exchange-documents element
+    return {
+        "publication_numbers": ["EP3000001A1", "EP3000002B1"],
+        "status_code": 200,
+        "response": {
+            "ops:world-patent-data": {
+                "exchange-documents": {
+                    "exchange-document": [d["exchange-document"] for d in documents]
+                }
+            }
+        },
+    }
+
+
+def test_iter_published_biblio():
+    memberships = {
+        "EP3000001A1": [("DE", "C", "10.0"), ("DE", "J", "62.0")],
+        "EP3000002B1": [("DE", "C", "10.0")],
+    }
+    rows = list(iter_published_biblio([published([FULL, SPARSE])], memberships))
+    assert [(row["query_industry"], row["document_doc-number"]) for row in rows] == [
+        ("C", "3000001"),
+        ("J", "3000001"),
+        ("C", "3000002"),
+    ]
+    assert rows[0] == EXPECTED[0] and rows[2] == EXPECTED[1]
+
+
+def test_iter_published_biblio_single_document():
+    rows = list(iter_published_biblio([published([SPARSE])], {}))
+    assert len(rows) == 1 and rows[0]["query_industry"] is None
@@ -0,0 +1,107 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+import requests
+
+from source.api import ENDPOINTS, OPSClient, docdb_number, valid_publication_numbers
+from source.harvest import create_jobs, fetch_biblio, harvest
+
+
+class FakeClient:
+    # records the batches instead of requesting OPS
+    def __init__(self, total_results=100):
+        self.total_results = total_results
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def fetch_biblio(self, batch):
+        with self.lock:
+            self.batches.append(list(batch))
+        return ok({})
+
+    def make_request(self, query, range_begin, range_end, endpoint):
+        time.sleep(0.001)
+        with self.lock:
+            self.batches.append((query, range_begin, range_end))
+        search = {"@total-result-count": str(self.total_results)}
+        return ok({"ops:world-patent-data": {"ops:biblio-search": search}})
+
+
+def ok(content):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps(content).encode("utf-8")
+    return response
+
+
+def test_docdb_number():
+    assert docdb_number("EP3000001A1") == "EP.3000001.A1"
+    assert docdb_number("US10000000B") == "US.10000000.B"
+    with pytest.raises(ValueError):
+        docdb_number("EP3000001")
+
+
+def test_invalid_numbers_are_skipped(caplog):
+    numbers = ["EP1A1", "bad", "EP2B1", "EP 3 A1"]
+    with caplog.at_level(logging.WARNING):
+        assert valid_publication_numbers(numbers) == ["EP1A1", "EP2B1"]
+    assert "bad" in caplog.text
+
+
+def test_fetch_biblio_keeps_batches_of_valid_numbers():
+    numbers = [f"EP{i}A1" for i in range(250)]
+    numbers.insert(50, "EP-invalid")
+    client = FakeClient()
+    records = list(fetch_biblio(numbers, client, batch_size=100, max_workers=2))
+    assert sorted(len(batch) for batch in client.batches) == [50, 100, 100]
+    assert sorted(sum(client.batches, [])) == sorted(numbers[:50] + numbers[51:])
+    assert all(record["status_code"] == 200 for record in records)
+
+
+def test_client_skips_invalid_numbers(monkeypatch):
+    client = OPSClient(None, None)
+    calls = []
+    monkeypatch.setattr(
+        client, "request", lambda method, url, data=None: calls.append((url, data))
+    )
+    client.fetch_biblio(["EP1A1", "bad", "EP2B1"])
+    assert calls == [(ENDPOINTS["biblio"], "EP.1.A1\nEP.2.B1")]
+
+
+def test_client_skips_batches_without_valid_numbers(monkeypatch):
+    client = OPSClient(None, None)
+    calls = []
+    monkeypatch.setattr(client, "request", lambda *args, **kwargs: calls.append(args))
+    assert client.fetch_biblio(["bad", "EP-1"]) is None
+    assert calls == []
+
+
+def test_harvest_paginates():
+    queries = {"DE": {"C": {"10.0": ["q1", "q2"]}}}
+    client = FakeClient(total_results=250)
+    pages = list(harvest(create_jobs(queries), client, max_workers=2, paginate=True))
+    assert sorted((job.query, job.range_begin) for job, _ in pages) == [
+        (q, begin) for q in ["q1", "q2"] for begin in [1, 101, 201]
+    ]
+
+
+def test_harvest_stops_requesting_when_closed():
+    queries = {"DE": {"C": {"10.0": [f"q{i}" for i in range(400)]}}}
+    client = FakeClient()
+    pages = harvest(create_jobs(queries), client, max_workers=4)
+    next(pages)
+    pages.close()
+    # only the window of requests in flight has been sent
+    assert len(client.batches) <= 2 * 4 + 1
+
+
+def test_fetch_biblio_stops_requesting_when_closed():
+    client = FakeClient()
+    numbers = [f"EP{i}A1" for i in range(10000)]
+    records = fetch_biblio(numbers, client, batch_size=10, max_workers=2)
+    next(records)
+    records.close()
+    assert len(client.batches) <= 2 * 2 + 1
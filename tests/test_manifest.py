@@ -0,0 +1,62 @@
+import sqlite3
+
+from source.harvest import create_jobs
+from source.manifest import DONE, FAILED, Manifest
+
+QUERIES = {"DE": {"C": {"10.0": ["q1", "q2"]}}}
+
+
+def manifest(tmp_path):
+    return Manifest(str(tmp_path / "manifest.sqlite"))
+
+
+def test_fresh_manifest_returns_all_jobs(tmp_path):
+    jobs = create_jobs(QUERIES)
+    assert manifest(tmp_path).pending(jobs) == jobs
+
+
+def test_done_pages_are_skipped_failed_pages_retried(tmp_path):
+    jobs = create_jobs(QUERIES)
+    m = manifest(tmp_path)
+    m.record(jobs[0], DONE, 200, 50, 1000)
+    m.record(jobs[1], FAILED, 500)
+    assert m.pending(jobs) == [jobs[1]]
+
+
+def test_resume_after_restart(tmp_path):
+    jobs = create_jobs(QUERIES)
+    m = manifest(tmp_path)
+    m.record(jobs[0], DONE, 200, 50, 1000)
+    m.close()
+    assert manifest(tmp_path).pending(jobs) == [jobs[1]]
+
+
+def test_missing_follow_up_pages_are_scheduled(tmp_path):
+    job = create_jobs(QUERIES)[0]
+    m = manifest(tmp_path)
+    m.record(job, DONE, 200, 250, 1000)
+    second = job._replace(range_begin=101, range_end=200)
+    m.record(second, DONE, 200, 250, 1000)
+    pending = m.pending([job], paginate=True)
+    assert [(j.range_begin, j.range_end) for j in pending] == [(201, 250)]
+    # follow-up pages are not requested beyond max_results
+    assert m.pending([job], paginate=True, max_results=200) == []
+
+
+def test_stale_pages_are_refreshed(tmp_path):
+    job = create_jobs(QUERIES)[0]
+    m = manifest(tmp_path)
+    m.record(job, DONE, 200, 50, 1000)
+    with sqlite3.connect(m.path) as connection:
+        connection.execute("UPDATE pages SET updated_at = '2000-01-01T00:00:00+00:00'")
+    assert m.pending([job]) == []
+    assert m.pending([job], max_age_days=30) == [job]
+
+
+def test_summary_counts_results_once_per_query(tmp_path):
+    job = create_jobs(QUERIES)[0]
+    m = manifest(tmp_path)
+    for range_begin, range_end in [(1, 100), (101, 200), (201, 250)]:
+        page = job._replace(range_begin=range_begin, range_end=range_end)
+        m.record(page, DONE, 200, 250, 10)
+    assert m.summary() == {DONE: {"pages": 3, "results": 250, "bytes": 30}}
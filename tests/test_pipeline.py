@@ -0,0 +1,138 @@
+import importlib
+import sys
+import textwrap
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from source.pipeline import File, Pipeline, function_hash
+
+HELPER = """
+def helper(x):
+    return x + {offset}
+"""
+
+STAGES = """
+from stagepkg.helpers import helper
+
+
+def compute(x):
+    return helper(x)
+"""
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    # importable package whose stage function calls a helper in another module
+    root = tmp_path / "modules"
+    (root / "stagepkg").mkdir(parents=True)
+    (root / "stagepkg" / "__init__.py").write_text("")
+    (root / "stagepkg" / "stages.py").write_text(textwrap.dedent(STAGES))
+    monkeypatch.syspath_prepend(str(root))
+    # rewritten modules must not be loaded from stale bytecode
+    monkeypatch.setattr(sys, "dont_write_bytecode", True)
+
+    def load(offset):
+        (root / "stagepkg" / "helpers.py").write_text(HELPER.format(offset=offset))
+        for name in ["stagepkg.helpers", "stagepkg.stages"]:
+            sys.modules.pop(name, None)
+        importlib.invalidate_caches()
+        return importlib.import_module("stagepkg.stages")
+
+    yield load
+    for name in ["stagepkg", "stagepkg.helpers", "stagepkg.stages"]:
+        sys.modules.pop(name, None)
+
+
+def counted(func):
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        calls.append(args)
+        return func(*args, **kwargs)
+
+    wrapper.calls = calls
+    return wrapper
+
+
+def test_stage_is_cached(tmp_path):
+    pipeline = Pipeline(str(tmp_path / "cache"))
+    func = counted(lambda df: df.assign(b=df["a"] * 2))
+    df = pd.DataFrame({"a": [1, 2, 3]})
+    first = pipeline.run("double", func, df)
+    second = Pipeline(str(tmp_path / "cache")).run("double", func, df)
+    pd.testing.assert_frame_equal(first, second)
+    assert len(func.calls) == 1
+    # changed inputs recompute the stage
+    Pipeline(str(tmp_path / "cache")).run("double", func, df.assign(a=[4, 5, 6]))
+    assert len(func.calls) == 2
+
+
+def test_version_invalidates_and_is_not_passed(tmp_path):
+    pipeline = Pipeline(str(tmp_path))
+    func = counted(lambda x: np.arange(x))
+    pipeline.run("range", func, 3)
+    pipeline.run("range", func, 3)
+    assert len(func.calls) == 1
+    pipeline.run("range", func, 3, version="2")
+    assert len(func.calls) == 2
+    assert pipeline.stage("range", func, 3, version="2").key != pipeline.stage(
+        "range", func, 3
+    ).key
+
+
+def test_changes_to_called_helpers_invalidate(package):
+    before = function_hash(package(1).compute)
+    assert function_hash(package(1).compute) == before
+    changed = package(2)
+    assert changed.compute(1) == 3
+    assert function_hash(changed.compute) != before
+
+
+def test_stages_are_lazy(tmp_path):
+    pipeline = Pipeline(str(tmp_path))
+    load = counted(lambda: pd.DataFrame({"a": [1, 2]}))
+    total = counted(lambda df: int(df["a"].sum()))
+    assert pipeline.run("total", total, pipeline.stage("load", load)) == 3
+    # the cached output of total does not need its input
+    pipeline = Pipeline(str(tmp_path))
+    assert pipeline.run("total", total, pipeline.stage("load", load)) == 3
+    assert len(load.calls) == 1 and len(total.calls) == 1
+
+
+def test_file_inputs_are_hashed_by_content(tmp_path):
+    path = tmp_path / "input.txt"
+    path.write_text("a")
+    pipeline = Pipeline(str(tmp_path / "cache"))
+    read = counted(lambda p: open(p).read())
+    assert pipeline.run("read", read, File(str(path))) == "a"
+    path.write_text("b")
+    assert pipeline.run("read", read, File(str(path))) == "b"
+    assert len(read.calls) == 2
+
+
+def test_panel_index_is_keyed_by_its_stage(tmp_path):
+    from source.statsvis import PanelIndex
+
+    def prep():
+        return pd.DataFrame(
+            {
+                "NACE": ["C", "C", "J", "J"],
+                "Indicator": ["Employees (n)"] * 4,
+                "Year": [2019, 2020, 2019, 2020],
+                "Sum patents": [1.0, 2.0, 3.0, 4.0],
+            }
+        )
+
+    count = counted(lambda df, panel: len(panel.cells))
+    keys = []
+    for _ in range(2):
+        # the DataFrame is computed in the first run and loaded from Parquet in the second
+        pipeline = Pipeline(str(tmp_path))
+        df = pipeline.run("prepped", prep)
+        stage = pipeline.stage("count", count, df, panel=PanelIndex(df))
+        keys.append(stage.key)
+        assert stage.value == 2
+    assert keys[0] == keys[1]
+    assert len(count.calls) == 1
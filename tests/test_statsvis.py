@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+import statsmodels.formula.api as smf
+
+from source.statsvis import (
+    PanelIndex,
+    batched_ols,
+    run_regressions,
+    run_panel_regressions,
+    run_regressions_batched,
+    stack_cells,
+)
+
+
+@pytest.fixture
+def data():
+    # unbalanced panel in the format of transform.prep_data()
+    rng = np.random.default_rng(1)
+    rows = []
+    for nace, n_years in [("C", 12), ("J", 9), ("K", 6)]:
+        patents = rng.poisson(30, n_years).astype(float)
+        for indicator in ["Employees (n)", "Enterprises (n)"]:
+            for i, year in enumerate(range(2008, 2008 + n_years)):
+                rows.append(
+                    {
+                        "NACE": nace,
+                        "Industry": f"Industry {nace}",
+                        "Indicator": indicator,
+                        "Year": year,
+                        "Sum patents": patents[i],
+                        "OBS_VALUE": 50 + 2 * patents[i] + rng.normal(0, 5),
+                    }
+                )
+    return pd.DataFrame(rows).sample(frac=1, random_state=0).reset_index(drop=True)
+
+
+INDUSTRIES = ["C", "J", "K"]
+INDICATORS = ["Employees (n)", "Enterprises (n)"]
+X_COLS = ["Sum patents", "Year"]
+
+
+def test_batched_ols_matches_statsmodels(data):
+    keys, X, y, nobs = stack_cells(data, INDUSTRIES, INDICATORS, X_COLS)
+    res = batched_ols(X, y, nobs)
+    panel = PanelIndex(data)
+    for c, (industry, indicator) in enumerate(keys):
+        cell = panel.cell(industry, indicator)
+        model = sm.OLS(cell["OBS_VALUE"], sm.add_constant(cell[X_COLS])).fit()
+        np.testing.assert_allclose(res["params"][c], model.params, rtol=1e-7)
+        np.testing.assert_allclose(res["bse"][c], model.bse, rtol=1e-7)
+        np.testing.assert_allclose(res["pvalues"][c], model.pvalues, rtol=1e-6, atol=1e-12)
+        assert res["df_resid"][c] == model.df_resid
+        assert res["rsquared"][c] == pytest.approx(model.rsquared, rel=1e-9)
+        np.testing.assert_allclose(
+            res["resid"][c, : nobs[c]], model.resid, rtol=1e-6, atol=1e-8
+        )
+
+
+def test_padding_does_not_change_the_fit(data):
+    keys, X, y, nobs = stack_cells(data, INDUSTRIES, INDICATORS, X_COLS)
+    res = batched_ols(X, y, nobs)
+    for c in range(len(keys)):
+        n = nobs[c]
+        single = batched_ols(X[c : c + 1, :n], y[c : c + 1, :n], nobs[c : c + 1])
+        np.testing.assert_allclose(res["params"][c], single["params"][0], rtol=1e-9)
+
+
+def test_run_regressions_batched_matches_run_regressions(data):
+    table = run_regressions_batched(data, INDUSTRIES, INDICATORS, X_COLS)
+    results = run_regressions(data, INDUSTRIES, INDICATORS, X_COLS)
+    for industry in INDUSTRIES:
+        for indicator in INDICATORS:
+            for model, fitted in enumerate(results[industry][indicator]):
+                rows = table.loc[(industry, indicator, model)]
+                np.testing.assert_allclose(rows["Coef."], fitted.params, rtol=1e-7)
+                np.testing.assert_allclose(rows["P>|t|"], fitted.pvalues, rtol=1e-6)
+
+
+def test_panel_index_cells(data):
+    panel = PanelIndex(data)
+    cell = panel.cell("J", "Enterprises (n)")
+    expected = data[(data["NACE"] == "J") & (data["Indicator"] == "Enterprises (n)")]
+    assert cell.index.equals(expected.index)
+    assert panel.group("Indicator", "Employees (n)").index.equals(
+        data.index[data["Indicator"] == "Employees (n)"]
+    )
+    # patents are counted once per industry and year
+    assert panel.nace_sum["C"] == data[
+        (data["NACE"] == "C") & (data["Indicator"] == "Employees (n)")
+    ]["Sum patents"].sum()
+
+
+@pytest.fixture
+def country_data():
+    # unbalanced country x industry x year panel of transform.prep_data(by_country=True)
+    rng = np.random.default_rng(2)
+    rows = []
+    for nace in ["C", "J"]:
+        for indicator in INDICATORS:
+            for country in ["AT", "BE", "DE", "FR", "IT"]:
+                effect = rng.normal(0, 20)
+                for year in range(2010, 2020):
+                    if rng.random() < 0.2:
+                        continue
+                    patents = rng.poisson(20)
+                    value = effect + 0.5 * year + 3 * patents + rng.normal(0, 4)
+                    rows.append(
+                        {
+                            "NACE": nace,
+                            "Indicator": indicator,
+                            "Country": country,
+                            "Year": year,
+                            "Sum patents": float(patents),
+                            "Share": rng.random(),
+                            "OBS_VALUE": value,
+                        }
+                    )
+    return pd.DataFrame(rows)
+
+
+def dummy_ols(cell, time_effects):
+    formula = "OBS_VALUE ~ Q('Sum patents') + Share + C(Country)"
+    return smf.ols(formula + (" + C(Year)" if time_effects else ""), data=cell)
+
+
+@pytest.mark.parametrize("time_effects", [False, True])
+def test_panel_regressions_match_dummy_ols(country_data, time_effects):
+    x_cols = ["Sum patents", "Share"]
+    terms = ["Q('Sum patents')", "Share"]
+    nonrobust = run_panel_regressions(
+        country_data,
+        ["C", "J"],
+        INDICATORS,
+        x_cols,
+        time_effects=time_effects,
+        cov_type="nonrobust",
+    )
+    cluster = run_panel_regressions(
+        country_data, ["C", "J"], INDICATORS, x_cols, time_effects=time_effects
+    )
+    for (nace, indicator), cell in country_data.groupby(["NACE", "Indicator"]):
+        model = dummy_ols(cell, time_effects).fit()
+        rows = nonrobust.loc[(nace, indicator)]
+        np.testing.assert_allclose(rows["Coef."], model.params[terms], rtol=1e-6)
+        np.testing.assert_allclose(rows["Std.Err."], model.bse[terms], rtol=1e-6)
+        np.testing.assert_allclose(rows["P>|t|"], model.pvalues[terms], rtol=1e-5)
+        # statsmodels counts the entity dummies in K, xtreg's (N-1)/(N-K) does not
+        clustered = dummy_ols(cell, time_effects).fit(
+            cov_type="cluster", cov_kwds={"groups": pd.factorize(cell["Country"])[0]}
+        )
+        n = len(cell)
+        k_all = model.df_model + 1
+        k_xtreg = len(x_cols) + 1 + (cell["Year"].nunique() - 1 if time_effects else 0)
+        expected = clustered.bse[terms] * np.sqrt((n - k_all) / (n - k_xtreg))
+        np.testing.assert_allclose(
+            cluster.loc[(nace, indicator)]["Std.Err."], expected, rtol=1e-6
+        )
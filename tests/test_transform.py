@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import signal
+
+from source.transform import detrend_groups
+
+
+@pytest.fixture
+def df():
+    # unbalanced groups, sorted by year within each group
+    rng = np.random.default_rng(0)
+    frames = []
+    for industry, indicator, n_years in [
+        ("C", "Employees", 12),
+        ("C", "Enterprises", 7),
+        ("K", "Employees", 2),
+        ("K", "Enterprises", 1),
+        ("J", "Employees", 9),
+    ]:
+        years = np.arange(2008, 2008 + n_years)
+        frames.append(
+            pd.DataFrame(
+                {
+                    "NACE": industry,
+                    "indic_sb_name": indicator,
+                    "TIME_PERIOD": years,
+                    "OBS_VALUE": 1e6 + 3e4 * (years - 2008) + rng.normal(0, 1e3, n_years),
+                    "sum_patents": rng.poisson(40, n_years).astype(float),
+                }
+            )
+        )
+    # interleave the groups, detrending must not depend on their order
+    return pd.concat(frames).sample(frac=1, random_state=0).sort_values(
+        "TIME_PERIOD", kind="stable"
+    )
+
+
+def per_group(df, cols, detrend_type):
+    # reference: scipy.signal.detrend applied to each group separately
+    result = df[cols].copy()
+    for _, group in df.groupby(["NACE", "indic_sb_name"]):
+        for col in cols:
+            result.loc[group.index, col] = signal.detrend(
+                group[col].to_numpy(), type=detrend_type
+            )
+    return result
+
+
+@pytest.mark.parametrize("detrend_type", ["linear", "constant"])
+def test_matches_scipy_per_group(df, detrend_type):
+    cols = ["OBS_VALUE", "sum_patents"]
+    detrended = detrend_groups(
+        df, by=["NACE", "indic_sb_name"], cols=cols, detrend_type=detrend_type
+    )
+    expected = per_group(df.reset_index(drop=True), cols, detrend_type)
+    np.testing.assert_allclose(
+        detrended.to_numpy(), expected.to_numpy(), rtol=1e-9, atol=1e-6
+    )
+    assert detrended.index.equals(df.index)
+
+
+def test_polynomial_trend_is_removed(df):
+    t = df.groupby(["NACE", "indic_sb_name"]).cumcount().to_numpy(dtype=float)
+    df = df.assign(OBS_VALUE=3 + 2 * t - 0.5 * t**2)
+    detrended = detrend_groups(
+        df, by=["NACE", "indic_sb_name"], cols=["OBS_VALUE"], detrend_type=np.int64(2)
+    )
+    np.testing.assert_allclose(detrended["OBS_VALUE"], 0, atol=1e-8)
+
+
+@pytest.mark.parametrize("detrend_type", ["quadratic", -1, 1.5, True])
+def test_invalid_detrend_type(df, detrend_type):
+    with pytest.raises(ValueError):
+        detrend_groups(df, by=["NACE"], cols=["OBS_VALUE"], detrend_type=detrend_type)
@@ -0,0 +1,68 @@
+import gzip
+
+import pytest
+
+from source.utils import JsonlWriter, read_jsonl
+
+
+def records(n):
+    return [{"id": i, "payload": "x" * 50} for i in range(n)]
+
+
+def crash(writer):
+    # simulate a crash: unsynced records are lost, the file is not closed properly
+    writer.buffer = []
+    writer.file.flush()
+
+
+def test_roundtrip(tmp_path):
+    path = str(tmp_path / "records.jsonl")
+    with JsonlWriter(path, batch_size=3) as writer:
+        for record in records(10):
+            writer.write(record)
+    assert list(read_jsonl(path)) == records(10)
+
+
+def test_append_across_writers(tmp_path):
+    path = str(tmp_path / "records.jsonl.gz")
+    for chunk in (records(5), records(7)):
+        with JsonlWriter(path) as writer:
+            for record in chunk:
+                writer.write(record)
+    assert list(read_jsonl(path)) == records(5) + records(7)
+
+
+def test_truncated_last_line_is_skipped(tmp_path):
+    path = str(tmp_path / "records.jsonl")
+    with JsonlWriter(path) as writer:
+        for record in records(4):
+            writer.write(record)
+    with open(path, "ab") as f:
+        f.write(b'{"id": 4, "payl')
+    assert list(read_jsonl(path)) == records(4)
+
+
+@pytest.mark.parametrize("suffix", [".jsonl", ".jsonl.gz"])
+def test_recovery_after_crash(tmp_path, suffix):
+    path = str(tmp_path / f"records{suffix}")
+    writer = JsonlWriter(path, batch_size=2, fsync_every=4)
+    for record in records(10):
+        writer.write(record)
+    crash(writer)
+    # everything up to the last checkpoint survives
+    recovered = list(read_jsonl(path))
+    assert recovered[:8] == records(8)
+    # a restarted harvest appends to the same file
+    with JsonlWriter(path) as writer:
+        writer.write({"id": "restart"})
+    assert list(read_jsonl(path))[-1] == {"id": "restart"}
+    assert list(read_jsonl(path))[:8] == records(8)
+
+
+def test_gzip_members_are_read_as_one_stream(tmp_path):
+    path = str(tmp_path / "records.jsonl.gz")
+    with JsonlWriter(path, fsync_every=2) as writer:
+        for record in records(5):
+            writer.write(record)
+    with gzip.open(path, "rb") as f:
+        assert len(f.read().splitlines()) == 5